@@ -1,26 +1,128 @@
 import traceback
 
-from threading import Thread, current_thread
+from threading import Thread, Timer, Lock, current_thread
 from Queue     import Queue, Empty
 
+from clock    import monotonic
+from queues   import MeteredQueue, BLOCK, DROP
+from protocol import JsonCall
+
 RUNNING = 1
 STOPPED = 2
 
+# rough size of an object once it has been encoded. good enough to decide when
+# a batch of results is big enough to be sent, at a fraction of the cost of
+# actually encoding it.
+def estimate(obj):
+	if type(obj) in [str, unicode]:
+		return len(obj) + 2
+	if type(obj) == dict:
+		return 2 + sum([len(k) + 4 + estimate(v) for (k, v) in obj.items()])
+	if type(obj) in [list, tuple]:
+		return 2 + sum([estimate(o) + 1 for o in obj])
+	return 8
+
+# collects the items of a result that is sent in chunks, e.g. a directory
+# listing, and responds with a chunk whenever enough items have piled up.
+# 'wrap' turns a list of items into the result to send. call finish() after
+# the last item to send the rest with more=False. the producer may take a long
+# time to come up with the next item (e.g. a slow directory), so a timer sends
+# whatever has piled up when the first item in it is max_delay seconds old.
+class Batcher(object):
+	msg       = None # the JsonCall to respond to
+	wrap      = None # function: list of items -> result
+	max_items = 0    # send a chunk when it has this many items,
+	max_bytes = 0    # or this many bytes (estimated),
+	max_delay = 0.25 # or when the first item in it is this many seconds old
+	items     = None # items that haven't been sent yet
+	size      = 0    # estimated size of the items
+	first     = None # monotonic time at which the first item was added
+	chunk     = 0    # sequence number of the next chunk
+	count     = 0    # total number of items added
+	timer     = None # sends the items when the first of them gets too old
+	lock      = None # the timer runs in a thread of its own
+
+	def __init__(self, msg, wrap, max_items, max_bytes):
+		self.msg       = msg
+		self.wrap      = wrap
+		self.max_items = max_items
+		self.max_bytes = max_bytes
+		self.items     = []
+		self.lock      = Lock()
+
+	def add(self, item):
+		self.lock.acquire()
+		try:
+			if not self.items:
+				self.first = monotonic()
+				self.timer = Timer(self.max_delay, self.expire, (self.first,))
+				self.timer.daemon = True
+				self.timer.start()
+			self.items.append(item)
+			self.size  += estimate(item)
+			self.count += 1
+			if (len(self.items) >= self.max_items
+			or  self.size >= self.max_bytes
+			or  monotonic() - self.first >= self.max_delay):
+				self.flush(True)
+		finally:
+			self.lock.release()
+
+	# called by the timer. 'first' tells which items the timer was started
+	# for. if they have been sent already, the timer is stale.
+	def expire(self, first):
+		self.lock.acquire()
+		try:
+			if self.items and self.first == first:
+				self.flush(True)
+		finally:
+			self.lock.release()
+
+	# the caller must hold the lock
+	def flush(self, more):
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+		self.msg.respond(0, u'', self.chunk, more, self.wrap(self.items))
+		self.chunk += 1
+		self.items  = []
+		self.size   = 0
+
+	def finish(self):
+		self.lock.acquire()
+		try:
+			self.flush(False)
+		finally:
+			self.lock.release()
+
 class Backend(Thread):
-	state     = RUNNING
-	name      = None
-	in_queue  = None
-	out_queue = None
+	state       = RUNNING
+	name        = None
+	in_queue    = None
+	out_queue   = None
+	batch_items = 1000      # largest number of items per result chunk
+	batch_bytes = 64 * 1024 # largest (estimated) size of a result chunk
+	peer_bytes  = None      # smaller chunk size asked for by the device
+	                        # manager, if any. negotiated in Hail
 	
 	def __init__(self, name, out_queue):
 		Thread.__init__(self, target=self.run, name=name)
 		self.name      = name
-		self.in_queue  = Queue(10)
+		self.in_queue  = MeteredQueue(u'backend', 100, self.in_policy)
 		self.out_queue = out_queue
 
 	def stop(self):
 		self.state = STOPPED
 
+	# calls from the device manager are refused when the queue is full, so
+	# that a slow scan or search can't block the conman thread that feeds the
+	# queue. the caller answers them with an error instead (see Conman.run()).
+	# anything else waits for room in the queue.
+	def in_policy(self, msg):
+		if isinstance(msg, JsonCall):
+			return DROP
+		return BLOCK
+
 	def run(self):
 		#print('starting %s' % current_thread().name)
 		self.on_start()
@@ -46,6 +148,12 @@ class Backend(Thread):
 	def get_track(self, guid):
 		raise Exception('Your backend must implement get_track()')
 
+	def make_batcher(self, msg, wrap):
+		max_bytes = self.batch_bytes
+		if self.peer_bytes:
+			max_bytes = min(max_bytes, self.peer_bytes)
+		return Batcher(msg, wrap, self.batch_items, max_bytes)
+
 	def handle(self, msg):
 		raise Exception('Your backend must implement _handle()')
 
@@ -18,6 +18,8 @@ from magic    import Magic
 from protocol import Ls, GetItem, Search, GetTerms, JsonResult, Terms
 from backend  import Backend
 
+import seekindex
+
 # private message class:
 class Scan(object):
 	pass
@@ -103,9 +105,10 @@ def classify_file(path, verbose=False):
 
 	return ('file', None)
 	
-def get_children(root_dir, guid, recursive, verbose=False):
+# generates the children of a directory, one at a time, so that they can be
+# sent while the rest of the directory is still being examined.
+def iter_children(root_dir, guid, recursive, verbose=False):
 	assert type(guid) == unicode
-	children = []
 	if guid == '/':
 		guid = ''
 	path = os.path.join(root_dir, guid)
@@ -124,15 +127,14 @@ def get_children(root_dir, guid, recursive, verbose=False):
 
 		child_guid = os.path.join(guid, l)
 		if os.path.isdir(path):
-			children.append({
+			yield {
 				'guid'  : child_guid,
 				'pretty': { 'label': l },
 				'kind'  :'dir'
-			})
+			}
 			if recursive:
-				children.extend(
-					get_children(root_dir, child_guid, recursive, verbose)
-				)
+				for c in iter_children(root_dir, child_guid, recursive, verbose):
+					yield c
 		elif os.path.isfile(path):
 			(format, audio) = classify_file(path)
 			if format in ['mp3', 'flac']:
@@ -148,7 +150,7 @@ def get_children(root_dir, guid, recursive, verbose=False):
 				n = None
 				if 'tracknumber' in audio.keys():
 					n = audio['tracknumber'][0]
-				children.append({
+				yield {
 					'guid'    : child_guid,
 					'pretty'  : {
 						'label' : l,
@@ -160,16 +162,15 @@ def get_children(root_dir, guid, recursive, verbose=False):
 					'kind'    : format,
 					'size'    : os.path.getsize(path),
 					'duration': int(audio.info.length * 1000)
-				})
+				}
 			else:
-				children.append({
+				yield {
 					'guid'  : child_guid,
 					'pretty': { 'label': l },
 					'kind'  : 'file'
-				})
+				}
 		elif verbose:
 			print('WARNING: Unsupported VFS content: %s' % path)
-	return children
 
 def get_item(root_dir, guid, verbose=False):
 	if guid == '/':
@@ -232,7 +233,11 @@ def get_index(db_curs, term):
 	db_curs.execute('select guid from search_index where term=?', (term,))
 	return [row[0] for row in db_curs]
 
-def scan(db_conn, db_curs, root_dir, guid, recursive, verbose=False):
+# if 'flacs' is a list, (key, path) tuples of all FLAC files are added to it
+# (see seekindex.prebuild()).
+def scan(
+	db_conn, db_curs, root_dir, guid, recursive, verbose=False, flacs=None
+):
 	assert type(guid) == unicode
 	if guid == '/':
 		guid = ''
@@ -267,10 +272,15 @@ def scan(db_conn, db_curs, root_dir, guid, recursive, verbose=False):
 					album = audio['album'][0]
 				for t in make_terms(title, artist, album, l):
 					set_index(db_curs, t, child_guid)
+				if format == 'flac' and flacs != None:
+					flacs.append((os.path.join(root_dir, child_guid), path))
 				continue
 
 		if os.path.isdir(path) and recursive:
-			scan(db_conn, db_curs, root_dir, child_guid, recursive, verbose)
+			scan(
+				db_conn, db_curs, root_dir, child_guid, recursive, verbose,
+				flacs
+			)
 
 		elif verbose:
 			print('WARNING: Unsupported VFS content: %s' % path)
@@ -285,22 +295,39 @@ class FileSystem(Backend):
 	root_dir = None
 	db_conn  = None
 	db_curs  = None
+	index_processes = 2 # processes that check FLAC files for the seek index
+	                    # during a scan. zero to not check them at all.
 
-	def __init__(self, name=None, out_queue=None, root_dir=None):
+	def __init__(
+		self, name=None, out_queue=None, root_dir=None, batch_items=None,
+		batch_bytes=None, index_processes=None
+	):
 		Backend.__init__(self, name, out_queue)
 		self.root_dir = root_dir
+		if batch_items:
+			self.batch_items = batch_items
+		if batch_bytes:
+			self.batch_bytes = batch_bytes
+		if index_processes != None:
+			self.index_processes = index_processes
 
 	def dump_settings(self):
 		return {
-			'root_dir': self.root_dir,
-			'name'    : self.name
+			'root_dir'       : self.root_dir,
+			'name'           : self.name,
+			'batch_items'    : self.batch_items,
+			'batch_bytes'    : self.batch_bytes,
+			'index_processes': self.index_processes
 		}
 	
 	@classmethod
 	def dump_defaults(self):
 		return {
-			'root_dir': os.environ['HOME'],
-			'name'    : u'CM ~%s' % os.environ['USER']
+			'root_dir'       : os.environ['HOME'],
+			'name'           : u'CM ~%s' % os.environ['USER'],
+			'batch_items'    : Backend.batch_items,
+			'batch_bytes'    : Backend.batch_bytes,
+			'index_processes': FileSystem.index_processes
 		}
 
 	def on_start(self):
@@ -325,12 +352,12 @@ class FileSystem(Backend):
 			def target(msg, root_dir, item_guid, recursive):
 				item = get_item(root_dir, item_guid)
 				if item:
-					result = get_children(root_dir, item_guid, recursive)
-					i = 0
-					for r in result:
-						msg.respond(0,u'',i,True, {'item':item,'contents':[r]})
-						i += 1
-					msg.respond(0, u'', i, False, {'item':item,'contents':[]})
+					batcher = self.make_batcher(
+						msg, lambda items: {'item':item, 'contents':items}
+					)
+					for r in iter_children(root_dir, item_guid, recursive):
+						batcher.add(r)
+					batcher.finish()
 				else:
 					msg.respond(1, u'No such directory', 0, False, None)
 
@@ -375,20 +402,19 @@ class FileSystem(Backend):
 					return
 				result = list(result)
 				result.sort()
-				i = 0
+				batcher = self.make_batcher(msg, lambda items: items)
 				for guid in result:
 					item = get_item(root_dir, guid)
 					if not item:
 						continue
-					msg.respond(0, u'', i, True, [item])
-					i += 1
-				if i == 0:
+					batcher.add(item)
+				if batcher.count == 0:
 					# this should really be a very rare occasion: the search
 					# index is soooo outdated that not a single hit actually
 					# corresponds to an existing file:
 					msg.respond(1, u'Nothing found', 0, False, None)
 				else:
-					msg.respond(0, u'', i, False, [])
+					batcher.finish()
 			
 			t = Thread(
 				target=target, name='Search', args=(msg, self.root_dir, terms)
@@ -399,10 +425,16 @@ class FileSystem(Backend):
 
 		if type(msg) == Scan:
 			# target() runs in own thread
-			def target(msg, root_dir):
+			def target(msg, root_dir, processes):
 				(db_conn, db_curs) = load_db()
-				scan(db_conn, db_curs, root_dir, u'', True, False)
-			t = Thread(target=target, name='Scan', args=(msg, self.root_dir))
+				flacs = []
+				scan(db_conn, db_curs, root_dir, u'', True, False, flacs)
+				if processes > 0:
+					seekindex.prebuild(flacs, processes)
+			t = Thread(
+				target=target, name='Scan',
+				args=(msg, self.root_dir, self.index_processes)
+			)
 			t.daemon = True
 			t.start()
 			return
@@ -0,0 +1,908 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+import sys
+import getopt
+import time
+import random
+import struct
+import socket
+import json
+import gc
+
+from threading import Thread
+from Queue     import Queue, Empty
+
+# PIL dependencies
+import Image
+import ImageDraw
+import ImageFont
+
+import fonts
+
+from canvas    import Canvas
+from canvas    import pack as canvas_pack
+from display   import Display, TRANSITION, BRIGHTNESS
+from render    import (TextRender, HighlightTextRender, NowPlayingRender,
+                       SearchRender, VolumeMeter)
+from scheduler import Scheduler
+from clock     import monotonic, NEVER
+from protocol  import (Strm, StrmStartMpeg, StrmStartFlac, StrmPause,
+                       StrmUnpause, StrmStop, StrmFlush, StrmStatus, StrmSkip,
+                       Grfe, Grfb, Aude, Audg, Updn, Visu, VisuNone, VisuMeter,
+                       VisuSpectrum, Ping, Helo, Tactile, Stat, Resp, Dsco,
+                       JsonResult, parse_header, parse_body,
+                       make_json_message)
+from tactile   import IR
+from device    import Classic, POWER
+from wire      import SlimWire, JsonWire, Stop
+import codec
+import recorder
+
+# the original implementation of Canvas.prepare_transmission(). kept here as a
+# reference that the current implementation must match byte for byte.
+def legacy_pack(image):
+	image = image.copy()
+	size  = image.size
+	for y in [8, 16, 24, 32]:
+		box = (0, y-8, size[0], y)
+		sub = image.crop(box).transpose(Image.FLIP_TOP_BOTTOM)
+		image.paste(sub, box)
+
+	pack = []
+	data = list(image.getdata()) # len() == x*y
+	for i in range(size[0]):
+		stripe = 0
+		for j in range(size[1]):
+			stripe = stripe | (data[j * size[0] + i] << j)
+		pack.append(struct.pack('<L', stripe))
+	return ''.join(pack)
+
+def make_noise(size):
+	image = Image.new('1', size, 0)
+	image.putdata([random.randint(0, 1) for i in range(size[0] * size[1])])
+	return image
+
+def make_text(size, text):
+	image = Image.new('1', size, 0)
+	font  = ImageFont.truetype(fonts.get_path('LiberationSerif-Regular'), 27)
+	draw  = ImageDraw.Draw(image)
+	draw.text((2, 0), text, font=font, fill=1)
+	return image
+
+def timed(function, image, rounds):
+	start = time.time()
+	for i in range(rounds):
+		function(image)
+	return (time.time() - start) / rounds
+
+def pack(argv):
+	def syntax():
+		print('Syntax: bench pack [--rounds <n>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['rounds='])
+	except:
+		syntax()
+
+	rounds = 200
+	for (opt, arg) in opts:
+		if opt == '--rounds':
+			try: rounds = int(arg)
+			except: syntax()
+
+	size   = Canvas((320,32)).size
+	images = [
+		('blank', Image.new('1', size, 0)),
+		('full' , Image.new('1', size, 1)),
+		('noise', make_noise(size)),
+		('text' , make_text(size, u'Nothing compares 2 U (Sin\xe9ad)'))
+	]
+
+	for (label, image) in images:
+		if canvas_pack(image) != legacy_pack(image):
+			print('%-6s MISMATCH between legacy and current packing' % label)
+			sys.exit(1)
+		legacy  = timed(legacy_pack, image, rounds)
+		current = timed(canvas_pack, image, rounds)
+		print(
+			'%-6s legacy %8.1f usec  current %8.1f usec  speedup %6.1fx'
+			% (label, legacy * 1e6, current * 1e6, legacy / current)
+		)
+
+# stands in for the volume control and display of a Classic device, as far as
+# Classic.next_deadline() is concerned.
+class Idle(object):
+	timeout   = 0     # the volume meter is not showing
+	redraw_at = NEVER # no frame has been dropped
+
+# mimics the main loop of a Classic device manager, either the old way (poll the
+# message queue with a 20ms timeout and tick on every wakeup) or with help from
+# a Scheduler. counts the number of times the thread wakes up. the deadlines
+# come from Classic.next_deadline() itself. the thread stops when it gets a
+# Stop message, which isn't counted as a wakeup.
+class TickingDevice(Thread):
+	def __init__(self, kind, index, scheduler):
+		Thread.__init__(self, name='TickingDevice')
+		self.kind      = kind
+		self.scheduler = scheduler
+		self.queue     = Queue(100)
+		self.canvas    = Canvas((320,32))
+		self.wakeups   = 0
+		self.power     = POWER.ON
+		self.volume    = Idle()
+		self.display   = Idle()
+		# text renders are singletons per font, size and position. give each
+		# simulated device its own render by varying the position.
+		self.render = TextRender(
+			fonts.get_path('LiberationSerif-Regular'), 27, (2, index)
+		)
+		if kind == 'scrolling':
+			self.render.curry(u'A track title that is far too long to fit')
+		else:
+			self.render.curry(u'Short title')
+		if kind == 'off':
+			self.power = POWER.OFF
+		# the first frame is drawn when the device says hello
+		self.render.tick(self.canvas)
+		self.last_render = self.render
+
+	def select_render(self):
+		return self.render
+
+	def run(self):
+		while True:
+			if self.scheduler:
+				deadline = Classic.next_deadline.im_func(self)
+				self.scheduler.schedule(self.queue, deadline)
+				msg = self.queue.get(block=True)
+			else:
+				try:
+					msg = self.queue.get(block=True, timeout=0.02)
+				except Empty:
+					msg = None
+			if isinstance(msg, Stop):
+				if self.scheduler:
+					self.scheduler.schedule(self.queue, NEVER)
+				return
+			self.wakeups += 1
+			if self.power == POWER.ON:
+				self.render.tick(self.canvas)
+
+def ticking(argv):
+	def syntax():
+		print('Syntax: bench ticking [--devices <n>] [--seconds <n>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['devices=', 'seconds='])
+	except:
+		syntax()
+
+	count   = 3
+	seconds = 5.0
+	for (opt, arg) in opts:
+		try:
+			if opt == '--devices':
+				count = int(arg)
+			if opt == '--seconds':
+				seconds = float(arg)
+		except:
+			syntax()
+
+	kinds = ['scrolling', 'idle', 'off']
+	for mode in ['polling', 'scheduled']:
+		scheduler = None
+		if mode == 'scheduled':
+			scheduler = Scheduler()
+			scheduler.start()
+		devices = []
+		for i in range(count):
+			for kind in kinds:
+				devices.append(TickingDevice(kind, len(devices), scheduler))
+		for d in devices:
+			d.start()
+		time.sleep(seconds)
+		for d in devices:
+			d.queue.put(Stop())
+		for d in devices:
+			d.join()
+		for kind in kinds:
+			wakeups = sum([d.wakeups for d in devices if d.kind == kind])
+			print(
+				'%-9s %-9s %8.2f wakeups/s/device'
+				% (mode, kind, wakeups / seconds / count)
+			)
+			if mode == 'scheduled' and kind in ['idle', 'off']:
+				# nothing to draw, so nothing should wake them up
+				assert wakeups == 0, '%s devices woke up' % kind
+		if scheduler:
+			print(
+				'%-9s %-9s %8.2f wakeups/s'
+				% (mode, 'scheduler', scheduler.wakeups / seconds)
+			)
+			scheduler.stop()
+			scheduler.join()
+
+# realistic track titles. some fit on the display, most have to scroll.
+titles = [
+	u'Heroes',
+	u'Nothing compares 2 U (Sin\xe9ad O\'Connor)',
+	u'Bohemian Rhapsody / A Night at the Opera / Queen',
+	u'Tr\xe4umerei, Kinderszenen Op. 15 No. 7 / Robert Schumann',
+	u'The Great Gig in the Sky / The Dark Side of the Moon / Pink Floyd',
+	u'Smells Like Teen Spirit / Nevermind / Nirvana',
+	u'Concerto for Two Violins in D minor, BWV 1043: I. Vivace'
+]
+
+# stands in for a menu item when currying NowPlayingRender
+class Track(object):
+	def __init__(self, title):
+		self.label = title
+
+	def get_pretty(self):
+		return self.label
+
+# every scenario is a function that curries a render for frame number i and
+# returns it. the render is then ticked as if its timeout had expired.
+def text_scenario(frames):
+	render = TextRender(fonts.get_path('LiberationSerif-Regular'), 27, (2,0))
+	def curry(i):
+		if i % (frames / len(titles) or 1) == 0:
+			render.curry(titles[(i * len(titles) / frames) % len(titles)])
+		return render
+	return curry
+
+def highlight_scenario(frames):
+	render = HighlightTextRender('LiberationMono', 20, (2, 10), True)
+	def curry(i):
+		if i % (frames / len(titles) or 1) == 0:
+			render.curry(titles[(i * len(titles) / frames) % len(titles)], 5)
+		return render
+	return curry
+
+def now_playing_scenario(frames):
+	render = NowPlayingRender()
+	track  = Track(titles[4])
+	def curry(i):
+		# the progress bar moves a little for every frame, like it does when
+		# a 5 minute track is playing and the title scrolls at 10 fps.
+		render.curry(float(i) / (10 * 300), track if i == 0 else None)
+		return render
+	return curry
+
+def search_scenario(frames):
+	render = SearchRender(True)
+	def curry(i):
+		if i % (frames / len(titles) or 1) == 0:
+			title = titles[(i * len(titles) / frames) % len(titles)]
+			render.curry(title, u'%s %s' % (title[:4], title[-4:]), 4)
+		return render
+	return curry
+
+def volume_scenario(frames):
+	render = VolumeMeter()
+	def curry(i):
+		render.curry((i * 3) % 101)
+		return render
+	return curry
+
+scenarios = [
+	('text'       , text_scenario),
+	('highlight'  , highlight_scenario),
+	('now_playing', now_playing_scenario),
+	('search'     , search_scenario),
+	('volume'     , volume_scenario)
+]
+
+# counts PIL images as they are created. images are by far the largest and most
+# frequent allocations made by renders and canvases.
+class ImageCounter(object):
+	count = 0
+
+	def __init__(self):
+		self.original = Image.Image.__init__
+		counter = self
+		def counting_init(image, *args, **kwargs):
+			counter.count += 1
+			counter.original(image, *args, **kwargs)
+		Image.Image.__init__ = counting_init
+
+	def stop(self):
+		Image.Image.__init__ = self.original
+
+# stands in for the wire of a display and counts the bytes sent through it
+class CountingWire(object):
+	sent_bytes = 0
+
+	def send(self, data):
+		self.sent_bytes += len(data)
+		return True
+
+# what the figures of run_scenario() mean. written to the results file so that
+# it explains itself.
+METRICS = {
+	'fps'              : 'frames ticked, drawn and sent per second',
+	'images_per_frame' : 'PIL images created per frame',
+	'retained_per_frame':
+		'gc tracked objects (containers) per frame that were still alive at '
+		'the end of the run with the garbage collector disabled: reference '
+		'cycles and growing caches. objects freed by reference counting and '
+		'objects that are not containers (e.g. str, int) are not counted. '
+		'Python 2 has no way to count all allocations.',
+	'bytes_per_frame'  : 'serialized Grfe bytes sent to the device per frame'
+}
+
+# drive a render like Classic.default_ticking() would do it but without a
+# device. returns a dictionary of per frame figures (see METRICS).
+def run_scenario(curry, frames):
+	wire        = CountingWire()
+	display     = Display((320,32), wire, BRIGHTNESS.FULL, 0)
+	canvas      = display.canvas
+	wire.sent_bytes = 0 # don't count the brightness command
+	counter     = ImageCounter()
+	gc.collect()
+	gc.disable()
+	before = len(gc.get_objects())
+	start  = time.time()
+	try:
+		for i in range(frames):
+			render = curry(i)
+			render.tick(canvas, force=True)
+			canvas.draw(render)
+			display.show(TRANSITION.NONE)
+		elapsed  = time.time() - start
+		# the render and display are local, so the objects they hold
+		# are still alive here
+		retained = len(gc.get_objects()) - before
+	finally:
+		gc.enable()
+		counter.stop()
+	return {
+		'frames'            : frames,
+		'seconds'           : elapsed,
+		'fps'               : frames / elapsed,
+		'images_per_frame'  : float(counter.count) / frames,
+		'retained_per_frame': float(retained) / frames,
+		'bytes_per_frame'   : float(wire.sent_bytes) / frames
+	}
+
+def renders(argv):
+	def syntax():
+		print('Syntax: bench renders [--frames <n>] [--output <file>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['frames=', 'output='])
+	except:
+		syntax()
+
+	frames = 2000
+	output = 'bench-renders.json'
+	for (opt, arg) in opts:
+		if opt == '--frames':
+			try: frames = int(arg)
+			except: syntax()
+		if opt == '--output':
+			output = arg
+
+	results = {}
+	print(
+		'%-12s %10s %13s %14s %14s'
+		% ('render', 'fps', 'images/frame', 'retained/frame', 'bytes/frame')
+	)
+	for (label, scenario) in scenarios:
+		r = run_scenario(scenario(frames), frames)
+		results[label] = r
+		print(
+			'%-12s %10.1f %13.2f %14.2f %14.1f'
+			% (label, r['fps'], r['images_per_frame'], r['retained_per_frame'],
+			   r['bytes_per_frame'])
+		)
+
+	f = open(output, 'w')
+	json.dump({
+		'time'   : time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python' : sys.version.split()[0],
+		'frames' : frames,
+		'metrics': METRICS,
+		'renders': results
+	}, f, indent=4, sort_keys=True)
+	f.close()
+	print('Results written to %s' % output)
+
+# the original implementations of Command.serialize(). kept here as a reference
+# that the precompiled layouts in protocol.py must match byte for byte.
+def legacy_header(cmd, params):
+	return struct.pack('<H', socket.htons(len(cmd + params))) + cmd + params
+
+def legacy_strm(self):
+	tmp = ( self.operation
+	      + self.autostart
+	      + self.format
+	      + self.pcm_sample_size
+	      + self.pcm_sample_rate
+	      + self.pcm_channels
+	      + self.pcm_endianness
+	      + struct.pack('<B', self.in_threshold)
+	      + self.spdif
+	      + struct.pack('<B', self.fade_time)
+	      + self.fade_type
+	      + struct.pack('<B', self.flags)
+	      + struct.pack('<B', self.out_threshold)
+	      + self.reserved
+	      + struct.pack('<HH', socket.htons(self.gain[0]),
+	                           socket.htons(self.gain[1]))
+	      + struct.pack('<H', socket.htons(self.server_port))
+	      + struct.pack('<L', socket.htonl(self.server_ip)) )
+	if self.operation == Strm.OP_START:
+		s = 'GET %s?seek=%s HTTP/1.0\r\n' % (self.resource, self.seek)
+		s = s.encode('utf-8')
+		tmp = tmp + struct.pack('%ds' % len(s), s)
+	return legacy_header('strm', tmp)
+
+def legacy_grfe(self):
+	return legacy_header('grfe',
+		  struct.pack('<H', socket.htons(self.offset))
+		+ self.transition
+		+ struct.pack('<B', self.distance)
+		+ self.bitmap
+	)
+
+def legacy_grfb(self):
+	return legacy_header('grfb', struct.pack('<H', socket.htons(self.brightness)))
+
+def legacy_aude(self):
+	return legacy_header('aude',
+		struct.pack('<B', self.analog) + struct.pack('<B', self.digital)
+	)
+
+def legacy_audg(self):
+	return legacy_header('audg',
+		  self.legacy
+		+ struct.pack('<BB', self.dvc, self.preamp)
+		+ struct.pack('>LL', self.left, self.right)
+	)
+
+def legacy_updn(self):
+	return legacy_header('updn', ' ')
+
+def legacy_visu(kind, parameters, values):
+	params = struct.pack('<B', kind) + struct.pack('<B', parameters)
+	for value in values:
+		params += struct.pack('<l', socket.htonl(value))
+	return legacy_header('visu', params)
+
+def legacy_visu_none(self):
+	return legacy_visu(Visu.NONE, 0, [])
+
+def legacy_visu_meter(self):
+	return legacy_visu(Visu.VUMETER, self.PARAMETERS, [
+		self.channels, self.style, self.left_pos, self.left_width,
+		self.right_pos, self.right_width
+	])
+
+def legacy_visu_spectrum(self):
+	return legacy_visu(Visu.SPECTRUM, self.PARAMETERS, [
+		self.channels, self.bandwidth, self.preemphasis,
+		self.left_pos, self.left_width, self.left_orientation,
+		self.left_bar_width, self.left_bar_spacing, self.left_clipping,
+		self.left_bar_intensity, self.left_cap_intensity,
+		self.right_pos, self.right_width, self.right_orientation,
+		self.right_bar_width, self.right_bar_spacing, self.right_clipping,
+		self.right_bar_intensity, self.right_cap_intensity
+	])
+
+def legacy_ping(self):
+	return legacy_header('stat', '')
+
+legacy_serializers = [
+	(Strm        , legacy_strm),
+	(Grfe        , legacy_grfe),
+	(Grfb        , legacy_grfb),
+	(Aude        , legacy_aude),
+	(Audg        , legacy_audg),
+	(Updn        , legacy_updn),
+	(VisuNone    , legacy_visu_none),
+	(VisuMeter   , legacy_visu_meter),
+	(VisuSpectrum, legacy_visu_spectrum),
+	(Ping        , legacy_ping)
+]
+
+def legacy_serialize(command):
+	for (cls, serializer) in legacy_serializers:
+		if isinstance(command, cls):
+			return serializer(command)
+	raise Exception, 'No legacy serializer for %s' % type(command)
+
+def make_commands():
+	size = Canvas((320,32)).size
+	grfe = Grfe()
+	grfe.transition = TRANSITION.NONE
+	grfe.bitmap     = canvas_pack(make_text(size, u'Nothing compares 2 U'))
+	part = Grfe()
+	part.offset     = 640
+	part.transition = TRANSITION.SCROLL_UP
+	part.bitmap     = grfe.bitmap[640:700]
+	grfb = Grfb()
+	grfb.brightness = 65535
+	return [
+		('strm_mpeg'  , StrmStartMpeg(0x7f000001, 3484, u'/m\xfcsic/a.mp3')),
+		('strm_flac'  , StrmStartFlac(0, 3484, u'/music/b.flac', 63000, True)),
+		('strm_pause' , StrmPause()),
+		('strm_unpause',StrmUnpause()),
+		('strm_stop'  , StrmStop()),
+		('strm_flush' , StrmFlush()),
+		('strm_status', StrmStatus()),
+		('strm_skip'  , StrmSkip(1500)),
+		('grfe'       , grfe),
+		('grfe_part'  , part),
+		('grfb'       , grfb),
+		('aude'       , Aude(True, False)),
+		('audg'       , Audg(True, 255, 73, 12)),
+		('updn'       , Updn()),
+		('visu_none'  , VisuNone()),
+		('visu_meter' , VisuMeter()),
+		('visu_meter2', VisuMeter(0,159, 161,159)),
+		('visu_spect' , VisuSpectrum()),
+		('ping'       , Ping())
+	]
+
+def commands(argv):
+	def syntax():
+		print('Syntax: bench commands [--rounds <n>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['rounds='])
+	except:
+		syntax()
+
+	rounds = 20000
+	for (opt, arg) in opts:
+		if opt == '--rounds':
+			try: rounds = int(arg)
+			except: syntax()
+
+	for (label, command) in make_commands():
+		current = command.serialize()
+		into    = bytearray(command.size())
+		command.pack_into(into, 0)
+		if str(into) != current:
+			print('%-12s MISMATCH between serialize() and pack_into()' % label)
+			sys.exit(1)
+		try:
+			legacy = legacy_serialize(command)
+		except struct.error, e:
+			# values with the high bit set after htonl() don't fit the signed
+			# fields that the legacy implementation packs them as.
+			print('%-12s legacy implementation failed: %s' % (label, e))
+			continue
+		if current != legacy:
+			print('%-12s MISMATCH between legacy and current serialization'
+			      % label)
+			sys.exit(1)
+		legacy  = timed(legacy_serialize, command, rounds)
+		current = timed(type(command).serialize, command, rounds)
+		print(
+			'%-12s legacy %6.2f usec  current %6.2f usec  speedup %5.1fx'
+			% (label, legacy * 1e6, current * 1e6, legacy / current)
+		)
+
+# the original message parsers. like the legacy serializers, they are kept as
+# a reference for the table driven parsers in protocol.py. the wire used to
+# copy the header and the body out of its inbox before parsing them.
+def legacy_parse_header(head):
+	kind = head[0:4]
+	if kind not in ['HELO', 'ANIC', 'IR  ', 'BYE!', 'STAT', 'RESP', 'UREQ',
+	                'JSON', 'DSCO']:
+		return (None, 0)
+	size = socket.ntohl(struct.unpack('<L', head[4:8])[0])
+	return (kind, size)
+
+def legacy_parse_helo_10(data, dlen):
+	id       = ord(data[0])
+	revision = ord(data[1])
+	tmp      = struct.unpack('<6BH', data[2:])
+	mac_addr = '%02x:%02x:%02x:%02x:%02x:%02x' % tuple(tmp[0:6])
+	return Helo(id, revision, mac_addr, 1234, 'EN')
+
+def legacy_parse_helo_36(data, dlen):
+	id       = ord(data[0])
+	revision = ord(data[1])
+	tmp      = struct.unpack('<6B16BHLL2s', data[2:])
+	mac_addr = tuple(tmp[0:6])
+	if id == 4 and mac_addr[0:3] == (0x0,0x4,0x20):
+		id = 104
+	uuid     = ''.join(str(i) for i in tmp[6:22])
+	language = tmp[25]
+	mac_addr = '%02x:%02x:%02x:%02x:%02x:%02x' % mac_addr
+	return Helo(id, revision, mac_addr, uuid, language)
+
+def legacy_parse_ir(data, dlen):
+	stamp   = socket.ntohl(struct.unpack('<L', data[0:4])[0])
+	format  = struct.unpack('<B', data[4:5])[0]
+	nr_bits = struct.unpack('<B', data[5:6])[0]
+	code    = socket.ntohl(struct.unpack('<L', data[6:10])[0])
+	return Tactile(code, 0)
+
+def legacy_parse_stat(data, dlen):
+	stat = Stat()
+	stat.event    = data[0:4]
+	stat.crlfs    = struct.unpack('<B', data[4])[0]
+	stat.mas_init = struct.unpack('<B', data[5])[0]
+	stat.mas_mode = struct.unpack('<B', data[6])[0]
+	stat.in_size  = socket.ntohl(struct.unpack('<L', data[ 7:11])[0])
+	stat.in_fill  = socket.ntohl(struct.unpack('<L', data[11:15])[0])
+	stat.recv_hi  = socket.ntohl(struct.unpack('<L', data[15:19])[0])
+	stat.recv_lo  = socket.ntohl(struct.unpack('<L', data[19:23])[0])
+	stat.wifi_pow = socket.ntohs(struct.unpack('<H', data[23:25])[0])
+	stat.jiffies  = socket.ntohl(struct.unpack('<L', data[25:29])[0])
+	stat.out_size = socket.ntohl(struct.unpack('<L', data[29:33])[0])
+	stat.out_fill = socket.ntohl(struct.unpack('<L', data[33:37])[0])
+	stat.seconds  = socket.ntohl(struct.unpack('<L', data[37:41])[0])
+	stat.voltage  = socket.ntohs(struct.unpack('<H', data[41:43])[0])
+	stat.msecs    = socket.ntohl(struct.unpack('<L', data[43:47])[0])
+	stat.stamp    = socket.ntohl(struct.unpack('<L', data[47:51])[0])
+	stat.error    = socket.ntohl(struct.unpack('<H', data[51:53])[0])
+	return stat
+
+def legacy_parse_dsco(data, dlen):
+	return Dsco(struct.unpack('<B', data[0])[0])
+
+def legacy_parse_body(kind, size, body):
+	if kind == 'HELO':
+		if size == 10:
+			return legacy_parse_helo_10(body, size)
+		return legacy_parse_helo_36(body, size)
+	if kind == 'IR  ':
+		return legacy_parse_ir(body, size)
+	if kind == 'STAT':
+		return legacy_parse_stat(body, size)
+	if kind == 'RESP':
+		return Resp(body)
+	if kind == 'DSCO':
+		return legacy_parse_dsco(body, size)
+
+def legacy_parse(inbox):
+	(kind, size) = legacy_parse_header(str(inbox[0:8]))
+	return legacy_parse_body(kind, size, str(inbox[8:8+size]))
+
+def current_parse(inbox):
+	(kind, size) = parse_header(inbox)
+	return parse_body(kind, size, memoryview(inbox)[8:8+size])
+
+def make_message(kind, body):
+	return bytearray(kind + struct.pack('>L', len(body)) + body)
+
+def make_messages():
+	# the error field of the STAT is zero because the legacy parser swaps
+	# the wrong number of bytes in it.
+	stat = struct.pack(
+		'>4sBBBLLLLHLLLLHLLH', 'STMt', 0, ord('m'), 2, 0x180000, 0x17f2a0, 0,
+		0x5e21c0a, 0xffff, 0x3bc41a2, 0x3c000, 0x1a000, 193, 0, 193230,
+		0x3bc40ff, 0
+	)
+	return [
+		('helo_10', make_message('HELO', struct.pack(
+			'>BB6BH', 4, 1, 0x00, 0x04, 0x20, 0x01, 0x02, 0x03, 11))),
+		('helo_36', make_message('HELO', struct.pack(
+			'>BB6B16BHLL2s', *([4, 1, 0x00, 0x04, 0x20, 0x01, 0x02, 0x03]
+			+ range(16) + [11, 0, 0, 'EN'])))),
+		('ir'     , make_message('IR  ', struct.pack(
+			'>LBBL', 0x3bc41a2, 0, 16, IR.VOLUME_UP))),
+		('stat'   , make_message('STAT', stat)),
+		('resp'   , make_message('RESP', 'HTTP/1.0 200 OK\r\n\r\n')),
+		('dsco'   , make_message('DSCO', struct.pack('>B', 2)))
+	]
+
+def messages(argv):
+	def syntax():
+		print('Syntax: bench messages [--rounds <n>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['rounds='])
+	except:
+		syntax()
+
+	rounds = 20000
+	for (opt, arg) in opts:
+		if opt == '--rounds':
+			try: rounds = int(arg)
+			except: syntax()
+
+	for (label, inbox) in make_messages():
+		if vars(current_parse(inbox)) != vars(legacy_parse(inbox)):
+			print('%-8s MISMATCH between legacy and current parsing' % label)
+			sys.exit(1)
+		legacy  = timed(legacy_parse, inbox, rounds)
+		current = timed(current_parse, inbox, rounds)
+		print(
+			'%-8s legacy %6.2f usec  current %6.2f usec  speedup %5.1fx'
+			% (label, legacy * 1e6, current * 1e6, legacy / current)
+		)
+
+# a directory listing like the ones that backend_fs.py produces
+def make_listing(tracks):
+	contents = []
+	for i in range(tracks):
+		title = titles[i % len(titles)]
+		contents.append({
+			'guid'    : u'/music/Various/%04d - %s.flac' % (i, title),
+			'pretty'  : {
+				'label' : u'%04d - %s.flac' % (i, title),
+				'artist': u'Various',
+				'album' : u'Album %d' % (i / 12),
+				'title' : title,
+				'n'     : u'%d' % (i % 12 + 1)
+			},
+			'kind'    : u'flac',
+			'size'    : 31234567 + i,
+			'duration': 243000 + i
+		})
+	item = { 'guid': u'/music/Various', 'pretty': { 'label': u'Various' },
+	         'kind': u'dir' }
+	return JsonResult(1, 0, u'', 0, False, {'item':item, 'contents':contents})
+
+# the plain json module, as used before codec.py existed
+class StdlibJson(codec.JsonCodec):
+	def encode(self, obj):
+		return json.dumps(obj)
+
+	def decode(self, data):
+		if type(data) == memoryview:
+			data = data.tobytes()
+		return json.loads(data)
+
+def codecs(argv):
+	def syntax():
+		print('Syntax: bench codecs [--tracks <n>] [--rounds <n>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['tracks=', 'rounds='])
+	except:
+		syntax()
+
+	tracks = 5000
+	rounds = 10
+	for (opt, arg) in opts:
+		if opt == '--tracks':
+			try: tracks = int(arg)
+			except: syntax()
+		if opt == '--rounds':
+			try: rounds = int(arg)
+			except: syntax()
+
+	message  = make_listing(tracks)
+	expected = message.dump()
+	print(
+		'%-8s %12s %12s %10s'
+		% ('codec', 'encode msec', 'decode msec', 'bytes')
+	)
+	candidates = [('stdlib', StdlibJson())]
+	candidates.extend([(c.name, c) for c in codec.codecs])
+	for (label, c) in candidates:
+		# decode the way the wire would, but with the codec under test
+		data = bytearray(message.serialize(c))
+		def decode(data):
+			return make_json_message(c.decode(memoryview(data)[8:]))
+		if decode(data).dump() != expected:
+			print('%-8s MISMATCH after a round trip' % label)
+			sys.exit(1)
+		encode = timed(message.serialize, c, rounds)
+		decode = timed(decode, data, rounds)
+		print(
+			'%-8s %12.1f %12.1f %10d'
+			% (label, encode * 1e3, decode * 1e3, len(data))
+		)
+
+# replaying a recording posts the messages that the wires would have posted to
+# device managers and connection handlers to a queue of this kind, which only
+# counts them.
+class Tally(Queue):
+	counts = None # message class name -> number of messages
+
+	def __init__(self):
+		Queue.__init__(self)
+		self.counts = {}
+
+	def put(self, item, block=True, timeout=None):
+		name = type(item).__name__
+		self.counts[name] = self.counts.get(name, 0) + 1
+
+# feed the bytes that were received on every recorded connection to a wire of
+# the recorded kind, in the recorded order. the wires have no sockets. with
+# 'realtime' the records are spaced out like they were when recorded. returns
+# (seconds, bytes fed, the worst lateness in seconds, Tally).
+def run_replay(records, realtime):
+	factories = { 'SlimWire': SlimWire, 'JsonWire': JsonWire }
+	tally = Tally()
+	wires = {} # connection number -> wire
+	fed   = 0
+	late  = 0.0
+	first = records[0][0]
+	start = monotonic()
+	for (stamp, connection, event, payload) in records:
+		if realtime:
+			due = start + (stamp - first)
+			now = monotonic()
+			if due > now:
+				time.sleep(due - now)
+			else:
+				late = max(late, now - due)
+		if event == recorder.OPEN:
+			(name, port) = payload.split(' ')
+			if name in factories:
+				wire = factories[name](u'', int(port), tally, accept=True)
+				wire._connected()
+				wires[connection] = wire
+		elif event == recorder.IN and connection in wires:
+			wire = wires[connection]
+			wire.inbox += payload
+			wire._consume()
+			fed += len(payload)
+		elif event == recorder.CLOSE:
+			wires.pop(connection, None)
+		# let wires with deadlines act on them, as the reactor would. at full
+		# speed hardly any time passes, so e.g. fewer key releases are seen
+		# than when the traffic was recorded.
+		for wire in wires.values():
+			deadline = wire._deadline()
+			if deadline != None and deadline <= monotonic():
+				wire._handle(None, None, None)
+	return (monotonic() - start, fed, late, tally)
+
+def replay(argv):
+	def syntax():
+		print('Syntax: bench replay <recording> [--realtime] [--rounds <n>]')
+		sys.exit(1)
+
+	try:
+		(opts, args) = getopt.gnu_getopt(argv, '', ['realtime', 'rounds='])
+	except:
+		syntax()
+	if len(args) != 1:
+		syntax()
+
+	realtime = False
+	rounds   = 10
+	for (opt, arg) in opts:
+		if opt == '--realtime':
+			realtime = True
+		if opt == '--rounds':
+			try: rounds = int(arg)
+			except: syntax()
+	if realtime:
+		rounds = 1
+
+	records = recorder.load(args[0])
+	if not records:
+		print('The recording is empty')
+		sys.exit(1)
+	print(
+		'%d records, %d connections, %.1f seconds of traffic'
+		% (len(records), len([r for r in records if r[2] == recorder.OPEN]),
+		   records[-1][0] - records[0][0])
+	)
+
+	best = None
+	for i in range(rounds):
+		(seconds, fed, late, tally) = run_replay(records, realtime)
+		if best == None or seconds < best:
+			best = seconds
+	count = sum(tally.counts.values())
+	for name in sorted(tally.counts):
+		print('%-12s %8d' % (name, tally.counts[name]))
+	print(
+		'%d messages from %d bytes in %.1f msec: %.1f usec per message, '
+		'%.1f MB/s' % (count, fed, best * 1e3, best * 1e6 / max(count, 1),
+		               fed / best / 1e6)
+	)
+	if realtime:
+		print('worst lateness %.1f msec' % (late * 1e3))
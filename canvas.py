@@ -4,8 +4,6 @@
 # under the terms of the GNU General Public License version 3, as published
 # by the Free Software Foundation.
 
-import struct
-
 # PIL dependencies
 import Image
 import ImageDraw
@@ -14,6 +12,7 @@ class Canvas:
 	bitmap   = ''    # Suitable for output to SqueezeBox with 'grfe' command
 	image    = None  # private member
 	size     = None  # pixel size of the drawable. tuple (x,y)
+	packed   = None  # the image that .bitmap was made from, if still valid
 
 	# the full SqueezeBox display is divided into stripes. depending on what
 	# is to be done, it should be thought of either as 320 vertical stripes
@@ -33,25 +32,37 @@ class Canvas:
 	def paste(self, image):
 		assert image != None
 		self.image = Image.composite(self.image, image, self.image)
+
+	# replace the canvas contents with a render's image. renders that know
+	# their image in packed form already (see Render.packed()) save us both
+	# the compositing and the packing.
+	def draw(self, render):
+		bitmap = render.packed()
+		if bitmap:
+			self.image  = render.image
+			self.bitmap = bitmap
+			self.packed = render.image
+		else:
+			self.clear()
+			self.paste(render.image)
 	
 	def prepare_transmission(self):
-		# SqueezeBox expects each 8 bit part of each vertical stripe to be
-		# sent in big endian bit order. unfortunately, this conflicts with
-		# the natural traverse order of drawables, but we can easily prepare
-		# the entire image for the transmission by transposing the horizontal
-		# stripes.
-		for y in [8, 16, 24, 32]:
-			box = (0, y-8, self.size[0], y)
-			sub = self.image.crop(box).transpose(Image.FLIP_TOP_BOTTOM)
-			self.image.paste(sub, box)
-
-		# pack each vertical stripe into unsigned 32 bit integers
-		pack = []
-		data = list(self.image.getdata()) # len() == x*y
-		for i in range(self.size[0]):
-			stripe = 0
-			for j in range(self.size[1]):
-				stripe = stripe | (data[j * self.size[0] + i] << j)
-			pack.append(struct.pack('<L', stripe))
-
-		self.bitmap = ''.join(pack) # ready for transmission
+		if self.packed is self.image:
+			return # already packed
+		self.bitmap = pack(self.image) # ready for transmission
+		self.packed = self.image
+
+# SqueezeBox expects each vertical stripe of the display to be sent as 32 bits,
+# with each 8 bit part of the stripe in big endian bit order (i.e. the topmost
+# pixel goes in the most significant bit). this happens to be exactly how PIL
+# represents the rows of a 1 bit image in raw form, so all we have to do is to
+# transpose the image (columns become rows) and dump the raw bytes. the whole
+# thing runs in PIL's C code instead of looping over every pixel in Python.
+def pack(image):
+	assert image.mode == '1'
+	assert image.size[1] % 8 == 0 # or PIL pads the rows of the transposition
+	transposed = image.transpose(Image.FLIP_LEFT_RIGHT)
+	transposed = transposed.transpose(Image.ROTATE_90)
+	if hasattr(transposed, 'tobytes'):
+		return transposed.tobytes()
+	return transposed.tostring() # PIL versions that predate tobytes()
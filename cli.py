@@ -10,7 +10,7 @@ import time
 
 from Queue    import Queue, Empty
 
-from protocol import Play, JsonResult, Add
+from protocol import Play, JsonResult, Add, GetStats
 from wire     import JsonWire, Connected
 
 def txrx(cmd):
@@ -100,3 +100,8 @@ def add(argv):
 	cmd = Add(0, url)
 	txrx(cmd)
 
+def stats(argv):
+	if argv:
+		print('Syntax: cli stats')
+		sys.exit(1)
+	txrx(GetStats(0))
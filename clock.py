@@ -0,0 +1,51 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+import sys
+import time
+import ctypes
+import ctypes.util
+
+# Python 2 has no monotonic clock in the standard library, so ask the C library
+# for one. deadlines that are based on wall clock time go haywire when the
+# system clock is adjusted (e.g. by NTP), which is why they should use this.
+
+NEVER = float('inf') # a deadline that never expires
+
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+if sys.platform == 'darwin':
+	CLOCK_MONOTONIC = 6
+else:
+	CLOCK_MONOTONIC = 1 # Linux and most others
+
+def load_clock_gettime():
+	for name in ['rt', 'c']:
+		path = ctypes.util.find_library(name)
+		if not path:
+			continue
+		try:
+			function = ctypes.CDLL(path).clock_gettime
+		except Exception:
+			continue
+		function.restype  = ctypes.c_int
+		function.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		spec = timespec()
+		if function(CLOCK_MONOTONIC, ctypes.byref(spec)) == 0:
+			return function
+	return None
+
+clock_gettime = load_clock_gettime()
+
+# seconds (float) since some unspecified point in time. only useful to compare
+# with other values returned by this function.
+def monotonic():
+	if not clock_gettime:
+		return time.time() # better than nothing
+	spec = timespec()
+	clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec))
+	return spec.tv_sec + spec.tv_nsec * 1e-9
@@ -7,6 +7,8 @@
 import sys
 import traceback
 
+import codec
+
 from connection import Connection
 from protocol   import Hail, JsonMessage, JsonResult, Terms
 
@@ -15,6 +17,8 @@ class CmConnection(Connection):
 	stream_ip   = 0
 	stream_port = 0
 	registered  = False
+	batch_bytes = 128 * 1024 # largest Ls or Search result chunk to accept.
+	                         # told to the content manager in the Hail reply
 	
 	def __init__(self, wire, out_queue):
 		Connection.__init__(self, wire, out_queue)
@@ -44,7 +48,13 @@ class CmConnection(Connection):
 				msg.respond(1, unicode(e), 0, False, False)
 				self.stop()
 				return
-			msg.respond(0, u'EOK', 0, False, True)
+			# content managers that don't list any codecs only speak JSON
+			chosen = codec.choose(msg.params.get('codecs', []))
+			self.wire.codec = chosen
+			msg.respond(0, u'EOK', 0, False, {
+				'codec'      : chosen.name,
+				'batch_bytes': self.batch_bytes
+			})
 			return
 
 		msg.sender = self.label
@@ -0,0 +1,98 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# encodings of the messages that dwite exchanges with content managers and
+# user interfaces. JSON is always available. ujson is used to encode and decode
+# it if installed, because the standard json module is slow on the Ls and
+# Search results of big libraries. MessagePack is more compact still and can
+# be used between dwite and a content manager if both sides have msgpack
+# installed. it is negotiated in the Hail that the content manager sends when
+# it connects.
+#
+# every codec uses a message kind of its own in the 8 byte message header, so
+# a receiver can always tell how a message is encoded, whatever was agreed.
+
+import json
+
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+class Codec(object):
+	name = None # unicode string. used in the codec negotiation
+	head = None # 4 byte message kind
+
+	def encode(self, obj):
+		raise Exception, 'All Codec subclasses must implement encode()'
+
+	# 'data' is a string or a memoryview
+	def decode(self, data):
+		raise Exception, 'All Codec subclasses must implement decode()'
+
+class JsonCodec(Codec):
+	name = u'json'
+	head = 'JSON'
+
+	if ujson:
+		def encode(self, obj):
+			return ujson.dumps(obj)
+
+		def decode(self, data):
+			if type(data) == memoryview:
+				data = data.tobytes()
+			return ujson.loads(data)
+	else:
+		def encode(self, obj):
+			return json.dumps(obj)
+
+		def decode(self, data):
+			if type(data) == memoryview:
+				data = data.tobytes()
+			return json.loads(data)
+
+class MsgPackCodec(Codec):
+	name = u'msgpack'
+	head = 'MPAK'
+
+	# all strings are packed as raw strings and unpacked as unicode, just like
+	# a JSON round trip would treat them.
+	def encode(self, obj):
+		return msgpack.packb(obj, use_bin_type=False)
+
+	def decode(self, data):
+		return msgpack.unpackb(data, raw=False)
+
+JSON    = JsonCodec()
+MSGPACK = None
+if msgpack:
+	MSGPACK = MsgPackCodec()
+
+# the codecs that are available in this process, most preferred first
+codecs = [c for c in [MSGPACK, JSON] if c]
+
+def names():
+	return [c.name for c in codecs]
+
+def get(name):
+	for c in codecs:
+		if c.name == name:
+			return c
+	raise Exception, 'Unknown codec %s' % name
+
+# pick the first of the named codecs that is available in this process. JSON
+# if none of them are.
+def choose(names):
+	for name in names:
+		for c in codecs:
+			if c.name == name:
+				return c
+	return JSON
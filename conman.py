@@ -14,6 +14,9 @@ import getopt
 import threading
 import json
 
+import codec
+import queues
+
 from Queue     import Queue, Empty
 from threading import Thread
 
@@ -41,7 +44,8 @@ class Conman(Thread):
 	def __init__(self):
 		Thread.__init__(self, target=Conman.run, name='Conman')
 		settings = self.load_settings()
-		self.queue    = Queue(100)
+		queues.configure(settings.get('queues', {}))
+		self.queue    = queues.MeteredQueue(u'conman', 100)
 		self.backend  = FileSystem(out_queue=self.queue, **settings['backend'])
 		self.streamer = Streamer(self.backend, self.queue)
 		self.jsonwire = JsonWire('', 3484, self.queue, accept=False)
@@ -95,8 +99,21 @@ class Conman(Thread):
 			if msg.errno:
 				print msg.errstr
 				self.stop()
+				return
+			# older device managers just reply True and only speak JSON
+			if type(msg.result) != dict:
+				return
+			if 'codec' in msg.result:
+				self.jsonwire.codec = codec.get(msg.result['codec'])
+			if 'batch_bytes' in msg.result:
+				self.backend.peer_bytes = msg.result['batch_bytes']
+		# older device managers reject a Hail with parameters they don't know,
+		# so only offer codecs if there is more to offer than plain JSON.
+		codecs = codec.names()
+		if codecs == [codec.JSON.name]:
+			codecs = None
 		guid = random.randint(1, 1000000)
-		hail = Hail(guid, self.backend.name, 0, self.streamer.port)
+		hail = Hail(guid, self.backend.name, 0, self.streamer.port, codecs)
 		self.handlers[guid] = (hail, handle_hail, None)
 		self.jsonwire.send(hail.serialize())
 
@@ -139,7 +156,10 @@ class Conman(Thread):
 					print msg
 				continue
 
-			self.backend.in_queue.put(msg)
+			if not self.backend.in_queue.put(msg):
+				# the backend is too far behind to take the call. answer it
+				# right away rather than keep the device manager waiting.
+				msg.respond(1, u'Content manager is busy', 0, False, None)
 
 		self.save_settings()
 
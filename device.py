@@ -12,8 +12,7 @@ import json
 import time
 
 from threading import Thread
-from Queue     import Queue, Empty
-from datetime  import datetime
+from Queue     import Queue, Empty, Full
 
 from protocol  import(Helo, Tactile, Stat, JsonResult, Terms, Dsco, Ping,
                       StrmStatus, Ls, GetItem, ID, JsonMessage, Resp, Anic,
@@ -24,9 +23,11 @@ from menu      import Menu, CmFile, CmAudio, CmDir, Link, make_item
 from player    import Player
 from seeker    import Seeker
 from render    import ProgressRender, OverlayRender
-from wire      import JsonWire
+from wire      import JsonWire, Stop
 from volume    import Volume
 from cm        import CmConnection
+from clock     import monotonic, NEVER
+from scheduler import Tick
 
 class POWER:
 	ON    = 1
@@ -126,7 +127,10 @@ class Device(Thread):
 				if not self.wire.is_alive():
 					self.stop(hard=True)
 				continue
-			if type(msg) == Helo:
+			if type(msg) == Stop:
+				# the wire died
+				self.stop(hard=True)
+			elif type(msg) == Helo:
 				# now we get to know what kind of device class we *really*
 				# should have used. create it and pass the Helo message to it.
 				if (msg.id == ID.SQUEEZEBOX3
@@ -149,6 +153,12 @@ class Device(Thread):
 		self.alive = False
 		self.save_settings()
 		self.save_playlist()
+		# the device thread may be blocked on its queue. wake it up so that it
+		# notices that it should terminate.
+		try:
+			self.in_queue.put(Tick(), block=False)
+		except Full:
+			pass
 
 	def add_cm(self, cm):
 		self.in_queue.put(AddCM(cm))
@@ -191,6 +201,8 @@ class Classic(Device):
 	acceleration = None # dict: different messages need different acceleration
 	                    # maps so keep a mapping from message codes to arrays
 	                    # of stress levels. only used for tactile events.
+	last_render  = None # the render that was last ticked by default_ticking()
+	overlay      = None # OverlayRender last returned by select_render()
 	_now_playing_mode = False
 
 	def __init__(self, wire, out_queue, mac_addr):
@@ -319,7 +331,7 @@ class Classic(Device):
 	def select_render(self):
 		# if the user recently manipulated the volume, check if the last
 		# rendering should be kept for a little longer.
-		if self.volume.timeout > datetime.now():
+		if self.volume.timeout > monotonic():
 			return self.volume.meter
 		# get the guids for the currently playing track (if any) and the
 		# currently visible menu item. if they happen to be the same, then
@@ -332,7 +344,7 @@ class Classic(Device):
 			# where the normal progress bar is replaced with a seek bar.
 			if self.seeker:
 				(guid3, render3) = self.seeker.ticker()
-				return OverlayRender(render2.base, render3)
+				return self.get_overlay(render2.base, render3)
 			# just return the NowPlaying render
 			return render2
 		# if the user is seeking, but the menu isn't focused on the currently
@@ -340,20 +352,65 @@ class Classic(Device):
 		# item's render and the render for showing the progress bar
 		if self.seeker:
 			(guid3, render3) = self.seeker.ticker()
-			return OverlayRender(render1, render3)
+			return self.get_overlay(render1, render3)
 		# just return the render for the currently focused menu item
 		sys.stdout.flush()
 		return render1
 
+	# select_render() is called on every tick. reuse the overlay it returned
+	# last time if it still combines the same renders. a new one would have to
+	# composite its images again even if nothing changed.
+	def get_overlay(self, base, overlay):
+		if (not self.overlay
+		or self.overlay.base    is not base
+		or self.overlay.overlay is not overlay):
+			self.overlay = OverlayRender(base, overlay)
+		return self.overlay
+
+	# the monotonic time at which default_ticking() has something to do, or
+	# NEVER if there is nothing to do until the next message arrives.
+	def next_deadline(self):
+		if self.power in [POWER.OFF, POWER.SLEEP]:
+			return NEVER
+		if not self.last_render:
+			# nothing has been curried before the Helo message is handled
+			return NEVER
+		deadline = self.select_render().deadline()
+		if self.volume.timeout > monotonic():
+			# the volume meter goes away when the timeout expires
+			deadline = min(deadline, self.volume.timeout)
+		# a frame was dropped by the wire and must be sent again
+		deadline = min(deadline, self.display.redraw_at)
+		return deadline
+
 	def default_ticking(self):
 		if self.power in [POWER.OFF, POWER.SLEEP]:
 			return
+		profiler = self.display.profiler
+		t0 = t = profiler.start()
 		render = self.select_render()
-		if render.tick(self.display.canvas):
-			self.display.canvas.clear()
-			self.display.canvas.paste(render.image)
+		t = profiler.lap('select_render', t)
+		# idle renders don't tick until they are curried again, so force a
+		# tick if the render selection changed (e.g. volume meter timed out).
+		force = render is not self.last_render
+		self.last_render = render
+		drawn = render.tick(self.display.canvas, force)
+		t = profiler.lap('tick', t)
+		if drawn:
+			self.display.canvas.draw(render)
+			profiler.lap('paste', t)
+			self.display.show(TRANSITION.NONE)
+			profiler.lap('frame', t0)
+		elif self.display.redraw_at <= monotonic():
+			# the canvas still holds the frame that was dropped
 			self.display.show(TRANSITION.NONE)
 
+	def dump_stats(self):
+		return {
+			'display': self.display.dump_stats(),
+			'profile': self.display.profiler.dump()
+		}
+
 	def find_ls_parent(self, item, orig_msg, response):
 		if response.result['item']['guid'] == '':
 			# parent is the menu root's CM widget. may be None if the CM is
@@ -420,12 +477,12 @@ class Classic(Device):
 				# redraw screen in case it was showing '<EMPTY>'
 				(guid, render) = self.menu.ticker(curry=True)
 				render.tick(self.display.canvas)
-				self.display.canvas.clear()
-				self.display.canvas.paste(render.image)
+				self.display.canvas.draw(render)
 				self.display.show(TRANSITION.NONE)
+				self.last_render = render
 
 	def run(self):
-		from dwite import unregister_dm, get_cm, msg_reg
+		from dwite import unregister_dm, get_cm, msg_reg, scheduler
 
 		# don't load the playlist in __init__() which is used on speculation
 		# that the resulting DM will be usable. this will happen a lot while
@@ -446,21 +503,26 @@ class Classic(Device):
 			transition = TRANSITION.NONE
 
 			try:
-				# waking up 50 times per second costs less than 1% CPU of a
-				# single core in an Intel Core2 Duo system, so lets do that
-				# to get good resolution in all ticking activities.
-				msg = self.in_queue.get(block=True, timeout=0.02)
-			except Empty:
-				if not self.wire.is_alive():
-					self.stop(hard=True)
-				else:
-					self.default_ticking()
-				continue
+				# sleep until the next message arrives or the scheduler posts
+				# a Tick because some render has something to draw. a device
+				# with nothing to draw doesn't wake up at all.
+				scheduler.schedule(self.in_queue, self.next_deadline())
+				msg = self.in_queue.get(block=True)
 			except:
 				traceback.print_exc()
 				self.stop(hard=True)
 				continue
 
+			if isinstance(msg, Tick):
+				if self.alive:
+					self.default_ticking()
+				continue
+
+			if isinstance(msg, Stop):
+				# the wire died
+				self.stop(hard=True)
+				continue
+
 			try:
 				#### MESSAGES FROM THE DWITE'S MAIN LOOP ####
 
@@ -513,10 +575,10 @@ class Classic(Device):
 					if msg.item == self.menu.focused():
 						(_, render) = self.player.ticker()
 						render.tick(self.display.canvas)
-						self.display.canvas.clear()
-						self.display.canvas.paste(render.image)
+						self.display.canvas.draw(render)
 						self.display.show(TRANSITION.NONE)
 						render.min_timeout(325)
+						self.last_render = render
 					msg.respond(0, u'EOK', 0, False, True)
 
 					if msg.item.parent:
@@ -940,15 +1002,16 @@ class Classic(Device):
 
 				if render:
 					if render.tick(self.display.canvas, force=True):
-						self.display.canvas.clear()
-						self.display.canvas.paste(render.image)
+						self.display.canvas.draw(render)
 						self.display.show(transition)
 						render.min_timeout(325)
+						self.last_render = render
 
 			except:
 				traceback.print_exc()
 				self.stop()
 
 		#print('Classic %s is Dead' % self.mac_addr)
+		scheduler.schedule(self.in_queue, NEVER)
 		unregister_dm(self.mac_addr)
 
@@ -6,6 +6,8 @@
 
 from canvas   import Canvas
 from protocol import Grfe, Grfb, VisuNone, VisuMeter, VisuSpectrum
+from profiler import Profiler
+from clock    import monotonic, NEVER
 
 # no intantiation of BRIGHTNESS is needed since it only carries constants
 # that share a name space.
@@ -33,6 +35,8 @@ class TRANSITION:
 	BOUNCE_LEFT  = 'R'
 	BOUNCE_RIGHT = 'L'
 
+REDRAW_DELAY = 0.1 # seconds to wait before redrawing after a dropped frame
+
 all_visualizers = [
 	VisuNone(),
 	VisuMeter(),
@@ -40,12 +44,44 @@ all_visualizers = [
 	VisuSpectrum()
 ]
 
+# compare two packed bitmaps column by column and return a list of byte ranges
+# (start, stop) that together cover all the differences. every Grfe command has
+# some overhead of its own, so ranges that are separated by fewer than 'gap'
+# unchanged bytes are merged. at most 'limit' ranges are returned.
+def diff_spans(old, new, stride, gap, limit):
+	assert len(old) == len(new)
+	spans = []
+	for i in xrange(0, len(new), stride):
+		if old[i:i+stride] == new[i:i+stride]:
+			continue
+		if spans and i - spans[-1][1] < gap:
+			spans[-1][1] = i + stride
+		else:
+			spans.append([i, i + stride])
+	# too many ranges. merge the ones that are closest to each other
+	while len(spans) > limit:
+		gaps = [spans[j+1][0] - spans[j][1] for j in range(len(spans) - 1)]
+		j = gaps.index(min(gaps))
+		spans[j][1] = spans[j+1][1]
+		del spans[j+1]
+	return [(start, stop) for (start, stop) in spans]
+
 class Display:
 	wire        = None
 	brightness  = BRIGHTNESS.FULL
 	canvas      = None
 	visualizers = iter(all_visualizers)
 	cur_visual  = None
+	last_bitmap = None # what the device is showing right now, and what kind
+	last_trans  = None # of transition was used to put it there.
+	partial     = True # send only the changed parts of the display?
+	profiler    = None # times the stages of the render pipeline
+	sent        = 0    # number of frames sent to the device
+	skipped     = 0    # number of frames not sent because nothing changed
+	partials    = 0    # number of frames sent as partial updates
+	sent_bytes  = 0    # number of serialized Grfe bytes sent
+	dropped     = 0    # number of frames dropped by a congested wire
+	redraw_at   = NEVER # when to send the whole display again after a drop
 	
 	def __init__(self, size, wire, brightness, visualizer):
 		assert brightness in [
@@ -55,8 +91,9 @@ class Display:
 			BRIGHTNESS.THREE,
 			BRIGHTNESS.FULL
 		]
-		self.wire   = wire
-		self.canvas = Canvas(size)
+		self.wire     = wire
+		self.canvas   = Canvas(size)
+		self.profiler = Profiler()
 		self.set_brightness(brightness)
 		self.cur_visual = all_visualizers[visualizer]
 		# set the iterator to the value that matches the visualizer parameter
@@ -81,6 +118,21 @@ class Display:
 			'visualizer': all_visualizers.index(self.cur_visual)
 		}
 
+	def dump_stats(self):
+		return {
+			'sent'    : self.sent,
+			'skipped' : self.skipped,
+			'partials': self.partials,
+			'bytes'   : self.sent_bytes,
+			'dropped' : self.dropped
+		}
+
+	# forget what the device is showing. the next call to show() will send
+	# a frame whether it changed or not.
+	def invalidate(self):
+		self.last_bitmap = None
+		self.last_trans  = None
+
 	def set_brightness(self, brightness, remember=True):
 		if brightness < BRIGHTNESS.OFF or brightness > BRIGHTNESS.FULL:
 			raise Exception, 'Unknown brightness code %d' % brightness
@@ -89,6 +141,7 @@ class Display:
 		grfb = Grfb()
 		grfb.brightness = BRIGHTNESS.map[brightness]
 		self.wire.send(grfb.serialize())
+		self.invalidate()
 	
 	def next_brightness(self):
 		if self.brightness - 1 < BRIGHTNESS.OFF:
@@ -101,22 +154,75 @@ class Display:
 			visu = self.visualizers.next()
 			self.wire.send(visu.serialize())
 			self.cur_visual = visu
+			self.invalidate()
 		except:
 			self.visualizers = iter(all_visualizers)
 			self.next_visualizer()
 
 	def visualizer_on(self):
 		self.wire.send(self.cur_visual.serialize())
+		self.invalidate()
 
 	def visualizer_off(self):
 		self.wire.send(VisuNone().serialize())
+		self.invalidate()
 
 	def show(self, transition):
+		self.redraw_at = NEVER
+		t = self.profiler.start()
 		self.canvas.prepare_transmission()
-		grfe = Grfe()
-		grfe.transition = transition
-		grfe.bitmap     = self.canvas.bitmap
-		self.wire.send(grfe.serialize())
+		t = self.profiler.lap('prepare_transmission', t)
+		bitmap = self.canvas.bitmap
+		# renders tick when their timeout expires, whether anything changed or
+		# not. don't bother the device with a frame it is already showing. the
+		# bitmap itself is used as the digest. it's only 1280 bytes for an SB2
+		# and comparing strings is cheaper than hashing them.
+		if transition == self.last_trans and bitmap == self.last_bitmap:
+			self.skipped += 1
+			return
+		# if the device shows a frame that wasn't put there with a transition,
+		# then only the columns that changed since then have to be sent. e.g.
+		# a progress bar that moves. transitions always need a full frame.
+		if (self.partial
+		and transition      == TRANSITION.NONE
+		and self.last_trans == TRANSITION.NONE):
+			stride = self.canvas.size[1] / 8 # bytes per column
+			spans  = diff_spans(self.last_bitmap, bitmap, stride, 12, 4)
+		else:
+			spans  = [(0, len(bitmap))]
+		if spans != [(0, len(bitmap))]:
+			self.partials += 1
+		grfes = []
+		for (start, stop) in spans:
+			grfe = Grfe()
+			grfe.offset     = start
+			grfe.transition = transition
+			grfe.bitmap     = bitmap[start:stop]
+			grfes.append(grfe)
+		# pack all the Grfe commands of the frame back to back, so that the
+		# frame is a single send on the wire.
+		data   = bytearray(sum([grfe.size() for grfe in grfes]))
+		offset = 0
+		for grfe in grfes:
+			offset = grfe.pack_into(data, offset)
+		t = self.profiler.lap('serialize', t)
+		sent = self.wire.send(data)
+		self.profiler.lap('send', t)
+		if not sent:
+			# the device still shows whatever was queued before, which may be
+			# several frames behind the canvas. the queued partial frames are
+			# diffs against each other, so they can't be replaced. instead the
+			# whole display is sent again as soon as the wire has had a moment
+			# to drain, even if nothing is drawn in the meantime.
+			self.dropped += 1
+			self.invalidate()
+			self.redraw_at = monotonic() + REDRAW_DELAY
+			return
+		self.sent_bytes += len(data)
+		self.profiler.frame()
+		self.last_bitmap = bitmap
+		self.last_trans  = transition
+		self.sent += 1
 
 	def clear(self):
 		self.canvas.clear()
@@ -13,14 +13,21 @@ import traceback
 import threading
 import os
 import random
+import json
+
+import queues
 
 from Queue    import Queue, Empty
 
 from device   import Device
-from wire     import SlimWire, JsonWire, Connected
+from wire     import Wire, SlimWire, JsonWire, Listener, Connected, reactor
 from cm       import CmConnection
 from ui       import UiConnection
 from protocol import JsonMessage
+from scheduler import Scheduler
+from profiler import Profiler
+from queues   import MeteredQueue
+from recorder import Recorder
 
 class MessageRegister(object):
 	handlers = {}
@@ -72,6 +79,9 @@ class MessageRegister(object):
 # global registry of message handlers
 msg_reg = MessageRegister()
 
+# wakes up device managers when their renders have something to draw
+scheduler = Scheduler()
+
 # device, content and ui managers. everything is threaded.
 dms = {}
 cms = {}
@@ -139,6 +149,29 @@ def get_dm(label):
 		return dms[label]
 	return None
 
+# settings that are not specific to any particular device
+def load_settings():
+	path = os.path.join(os.environ['DWITE_CFG_DIR'], 'dwite.json')
+	settings = {}
+	if os.path.exists(path):
+		f = open(path)
+		try:
+			settings = json.load(f)
+		except:
+			print('ERROR: Could not load settings file %s' % path)
+			settings = {}
+		f.close()
+	# time the stages of the render pipeline? see profiler.py
+	if 'profiling' not in settings:
+		settings['profiling'] = False
+	# queue name -> capacity. see queues.py
+	if 'queues' not in settings:
+		settings['queues'] = {}
+	# file to record all wire traffic to, or None. see recorder.py
+	if 'recording' not in settings:
+		settings['recording'] = None
+	return settings
+
 def main():
 	# check for directory of configuration files
 	path = os.environ['DWITE_CFG_DIR']
@@ -147,22 +180,31 @@ def main():
 	if not os.path.isdir(path):
 		raise Exception('No configuration directory "%s"' % path)
 
+	settings = load_settings()
+	queues.configure(settings['queues'])
+
 	# a queue to be used by all newly created wires to drop messages here.
-	queue = Queue(100)
+	queue = MeteredQueue(u'dwite', 100)
+	Profiler.enabled = settings['profiling']
+	if settings['recording']:
+		Wire.recorder = Recorder(settings['recording'])
+
+	scheduler.start()
 
 	try:
-		# threaded "wire" objects handle the socket connections with devices,
-		# content managers and user interfaces.
-		ui_wire = JsonWire('', 3482, queue, accept=True)
-		dm_wire = SlimWire('', 3483, queue, accept=True)
-		cm_wire = JsonWire('', 3484, queue, accept=True)
-		ui_wire.start()
-		dm_wire.start()
-		cm_wire.start()
-
-		# wait for Connected messages from the wires. whenever one gets
-		# connected create a new one so that more devices, etc, can connect
-		# to dwite.
+		# "wire" objects handle the socket connections with devices, content
+		# managers and user interfaces. they all share the reactor thread.
+		# the listeners create a new wire for every accepted connection.
+		listeners = [
+			Listener(3482, JsonWire, queue),
+			Listener(3483, SlimWire, queue),
+			Listener(3484, JsonWire, queue)
+		]
+		for listener in listeners:
+			listener.start()
+
+		# wait for Connected messages from the listeners and hand the new
+		# wires over to the right kind of connection handler.
 		while True:
 			msg = None
 			try:
@@ -171,24 +213,18 @@ def main():
 				continue
 
 			if type(msg) == Connected:
-				if msg.wire == ui_wire:
-					UiConnection(ui_wire, queue).start()
-					ui_wire = JsonWire('', 3482, queue, accept=True)
-					ui_wire.start()
-				elif msg.wire == dm_wire:
+				if msg.port == 3482:
+					UiConnection(msg.wire, queue).start()
+				elif msg.port == 3483:
 					# we need more information about the remote end before a
 					# fully proper DM representation can be created. in the
 					# meanwhile we still have to do *something*, so we use
 					# the base class Device as a placeholder. it will make the
 					# necessary corrections itself when more about the remote
 					# end becomes known.
-					Device(dm_wire, queue).start()
-					dm_wire = SlimWire('', 3483, queue, accept=True)
-					dm_wire.start()
-				elif msg.wire == cm_wire:
-					CmConnection(cm_wire, queue).start()
-					cm_wire = JsonWire('', 3484, queue, accept=True)
-					cm_wire.start()
+					Device(msg.wire, queue).start()
+				elif msg.port == 3484:
+					CmConnection(msg.wire, queue).start()
 				continue
 
 			raise Exception('INTERNAL ERROR: Garbage message: %s' % msg)
@@ -200,15 +236,18 @@ def main():
 		traceback.print_exc()
 
 	# stop all threaded objects and quit
-	ui_wire.stop(hard=True)
-	dm_wire.stop(hard=True)
-	cm_wire.stop(hard=True)
+	for listener in listeners:
+		listener.stop(hard=True)
 	for dm in dms.values():
 		dm.stop()
 	for cm in cms.values():
 		cm.stop()
 	for ui in uis.values():
 		ui.stop()
+	scheduler.stop()
+	reactor.stop()
+	if Wire.recorder:
+		Wire.recorder.close()
 
 	while threading.active_count() > 1:
 		print [t.name for t in threading.enumerate()]
@@ -15,8 +15,8 @@ class FlacDecoder(object):
 	path    = None
 
 	def __del__(self):
-		self.__decoder_delete(self.decoder)
-		pass
+		if self.decoder: # not set if libFLAC couldn't be loaded
+			self.__decoder_delete(self.decoder)
 
 	def __init__(self, path):
 		self.__load_libflac()
@@ -0,0 +1,207 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# finds the frame of a FLAC file that holds a given point in time without
+# walking all frames of the file. most files have a SEEKTABLE, which gives the
+# offsets of frames that start a few seconds apart. the frames in between (or
+# in the whole file, if there is no seek table) are found with a binary search
+# over frame headers: the byte offsets of the search are not aligned with the
+# frames, so every probe looks for the next frame sync code and checks that it
+# really starts a frame header before it reads the header's sample number.
+# the number of probes grows with the logarithm of the distance between seek
+# points (or of the file size), and every probe reads a small window of bytes.
+
+import struct
+
+NO_POINT = 0xFFFFFFFFFFFFFFFF # first sample of a placeholder seek point
+WINDOW   = 64 * 1024          # bytes to read per probe if the largest frame
+                              # size of the stream is unknown
+
+# CRC-8 with the polynomial x^8 + x^2 + x^1 + x^0, which protects frame headers
+CRC8 = []
+for i in range(256):
+	crc = i
+	for j in range(8):
+		if crc & 0x80:
+			crc = ((crc << 1) ^ 0x07) & 0xFF
+		else:
+			crc = (crc << 1) & 0xFF
+	CRC8.append(crc)
+
+def crc8(data, start, stop):
+	crc = 0
+	for i in range(start, stop):
+		crc = CRC8[crc ^ ord(data[i])]
+	return crc
+
+# the byte offset of the first frame, right after the last metadata block. an
+# ID3v2 tag in front of the stream is skipped.
+def first_frame(file):
+	file.seek(0)
+	head = file.read(10)
+	offset = 0
+	if head[0:3] == 'ID3' and len(head) == 10:
+		size = 0
+		for c in head[6:10]:
+			size = (size << 7) | (ord(c) & 0x7F)
+		offset = 10 + size
+		if ord(head[5]) & 0x10:
+			offset += 10 # footer
+		file.seek(offset)
+		head = file.read(4)
+	if head[0:4] != 'fLaC':
+		raise Exception('Not a FLAC stream')
+	offset += 4
+	while True:
+		file.seek(offset)
+		(word,) = struct.unpack('>L', file.read(4))
+		offset += 4 + (word & 0xFFFFFF)
+		if word & 0x80000000:
+			return offset
+
+class Stream(object):
+	file      = None
+	fixed     = 0    # samples per frame if they are all the same, or 0
+	signature = None # (sample rate/block size byte, channels/bits byte) of
+	                 # the first frame. all frames of a stream must agree.
+	window    = 0    # bytes to read per probe. every window holds the start
+	                 # of a frame, unless it is at the end of the stream.
+
+	def __init__(self, file, info):
+		self.file   = file
+		self.window = WINDOW
+		if info.max_framesize:
+			self.window = 2 * info.max_framesize + 16
+		if info.min_blocksize == info.max_blocksize:
+			self.fixed = info.max_blocksize
+
+	# returns the first sample of the frame whose header starts at 'i' in
+	# 'data', or None if there is no valid frame header there or its first
+	# sample can't be known.
+	def parse(self, data, i):
+		if len(data) - i < 16:
+			return None # too short for the longest header
+		if ord(data[i]) != 0xFF or (ord(data[i+1]) & 0xFE) != 0xF8:
+			return None
+		variable = ord(data[i+1]) & 0x01
+		block    = ord(data[i+2]) >> 4
+		rate     = ord(data[i+2]) & 0x0F
+		if block == 0 or rate == 15 or ord(data[i+3]) & 0x01:
+			return None
+		if self.signature and self.signature != (rate, ord(data[i+3])):
+			return None
+		# frame or sample number, UTF-8 style
+		j = i + 4
+		c = ord(data[j])
+		if c < 0x80:
+			(number, more) = (c, 0)
+		elif c >= 0xC0 and c < 0xFE:
+			more = 1
+			while c & (0x40 >> more):
+				more += 1
+			number = c & (0x3F >> more)
+		else:
+			return None
+		for k in range(more):
+			j += 1
+			c = ord(data[j])
+			if c & 0xC0 != 0x80:
+				return None
+			number = (number << 6) | (c & 0x3F)
+		j += 1
+		if block == 6:
+			j += 1
+		elif block == 7:
+			j += 2
+		if rate == 12:
+			j += 1
+		elif rate in [13, 14]:
+			j += 2
+		if crc8(data, i, j) != ord(data[j]):
+			return None
+		if variable:
+			return number
+		if not self.fixed:
+			# a frame number, but STREAMINFO doesn't say how many samples the
+			# frames before this one hold, so there is no telling where it
+			# starts. the caller must find the frames some other way.
+			return None
+		return number * self.fixed
+
+	# returns (offset, first sample) of the first frame that starts in
+	# [start, stop), or None if there is none within a window from 'start'.
+	def find(self, start, stop):
+		self.file.seek(start)
+		data = self.file.read(min(self.window, stop - start) + 16)
+		limit = min(len(data), stop - start)
+		i = data.find('\xff')
+		while i >= 0 and i < limit:
+			sample = self.parse(data, i)
+			if sample != None:
+				return (start + i, sample)
+			i = data.find('\xff', i + 1)
+		return None
+
+# returns the offset of the frame that holds 'msec', or None if it can't be
+# found (e.g. because the file is damaged). 'audio' is a mutagen.flac.FLAC and
+# 'size' is the size of the file.
+def time_to_offset(audio, file, size, msec):
+	info   = audio.info
+	target = msec * info.sample_rate / 1000
+	stream = Stream(file, info)
+	start  = first_frame(file)
+	file.seek(start)
+	head = file.read(16)
+	if not info.max_blocksize or stream.parse(head, 0) == None:
+		return None
+	stream.signature = (ord(head[2]) & 0x0F, ord(head[3]))
+
+	# the last frame known to start at or before the target, and an offset
+	# after which all frames start after it.
+	lo = (start, 0)
+	hi = size
+	if audio.seektable:
+		for point in audio.seektable.seekpoints:
+			if point.first_sample == NO_POINT:
+				continue
+			if point.first_sample <= target:
+				candidate = (start + point.byte_offset, point.first_sample)
+				if candidate[0] > lo[0]:
+					lo = candidate
+			else:
+				hi = min(hi, start + point.byte_offset)
+				break
+		# trust the seek point only if there is a matching frame at or right
+		# after it.
+		if lo[0] > start:
+			found = stream.find(lo[0], hi)
+			if found and found[1] == lo[1]:
+				lo = found
+			else:
+				(lo, hi) = ((start, 0), size)
+
+	# narrow it down until the rest can be scanned within a few windows
+	while hi - lo[0] > 2 * stream.window:
+		middle = (lo[0] + hi) / 2
+		found  = stream.find(middle, hi)
+		if found and found[1] <= target:
+			lo = found
+		else:
+			# no frame starts between 'middle' and the one that was found,
+			# so the target frame can only start before 'middle'. finding
+			# nothing at all means that 'middle' is in the last frame.
+			hi = middle
+
+	# step through the remaining frames until the next one is too late
+	result = lo
+	offset = lo[0] + 1
+	while offset < hi:
+		found = stream.find(offset, hi)
+		if not found or found[1] > target:
+			break
+		result = found
+		offset = found[0] + 1
+	return result[0]
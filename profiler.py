@@ -0,0 +1,108 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# opt-in timing of the render pipeline. every display has a Profiler that
+# collects latency histograms for the stages that make a frame, and counts
+# the frames that were actually sent to get the frame rate. the results can be
+# fetched with the get_stats method on the UI port (see "cli stats").
+
+from threading   import Lock
+from collections import deque
+from bisect      import bisect_left
+
+from clock import monotonic
+
+# upper bounds of the histogram buckets, in milliseconds. a frame is due every
+# 100 msecs while scrolling and must not take more than a fraction of that.
+BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0]
+
+class Histogram(object):
+	counts = None # one count per bucket plus one for everything slower
+	total  = 0.0  # sum of all samples, in milliseconds
+	worst  = 0.0  # the slowest sample, in milliseconds
+
+	def __init__(self):
+		self.counts = [0] * (len(BUCKETS) + 1)
+
+	def add(self, msecs):
+		# index of the first bucket whose upper bound is >= msecs
+		self.counts[bisect_left(BUCKETS, msecs)] += 1
+		self.total     += msecs
+		self.worst      = max(self.worst, msecs)
+
+	def dump(self):
+		count = sum(self.counts)
+		mean  = 0.0
+		if count:
+			mean = self.total / count
+		return {
+			'count'  : count,
+			'mean_ms': mean,
+			'max_ms' : self.worst,
+			# the last bucket has no upper bound
+			'buckets': zip(BUCKETS + [None], self.counts)
+		}
+
+class Profiler(object):
+	enabled = False # class wide switch. set from the settings in dwite.json
+	lock    = None
+	stages  = None  # dictionary: stage name -> Histogram
+	frames  = None  # monotonic times of the most recently sent frames
+
+	def __init__(self):
+		self.lock   = Lock()
+		self.stages = {}
+		self.frames = deque(maxlen=100)
+
+	# returns a time stamp to pass to lap(), or None if profiling is off. the
+	# callers are in the hot path, so they only pay for a function call and a
+	# comparison when nobody is looking.
+	def start(self):
+		if not self.enabled:
+			return None
+		return monotonic()
+
+	# record the time since 'then' for a stage. returns a new time stamp so
+	# that consecutive stages can be chained.
+	def lap(self, stage, then):
+		if then == None:
+			return None
+		now = monotonic()
+		self.lock.acquire()
+		if stage not in self.stages:
+			self.stages[stage] = Histogram()
+		self.stages[stage].add((now - then) * 1000)
+		self.lock.release()
+		return now
+
+	def frame(self):
+		if not self.enabled:
+			return
+		self.lock.acquire()
+		self.frames.append(monotonic())
+		self.lock.release()
+
+	# frames per second over the frames that were sent during the last five
+	# seconds.
+	def fps(self):
+		now    = monotonic()
+		recent = [t for t in self.frames if now - t <= 5.0]
+		if len(recent) < 2:
+			return 0.0
+		return (len(recent) - 1) / (now - recent[0])
+
+	def dump(self):
+		self.lock.acquire()
+		try:
+			return {
+				'enabled': self.enabled,
+				'fps'    : self.fps(),
+				'stages' : dict(
+					(name, h.dump()) for (name, h) in self.stages.items()
+				)
+			}
+		finally:
+			self.lock.release()
@@ -7,10 +7,10 @@
 import sys
 import struct
 import socket
-import json
 import math
 
 from tactile import IR
+from codec   import JSON, MSGPACK
 
 class ID:
 	SQUEEZEBOX   = 2
@@ -50,6 +50,12 @@ class ID:
 # Device message: size field located [4:8], unsigned long, little endian.
 # Device command: size field located [0:2], unsigned short, little endian.
 # JSON message:   exactly like device message.
+#
+# the "little endian" above is what it looks like when the fields are packed
+# with '<' after being passed through socket.htons() or htonl() on an x86. the
+# bytes on the wire are in network order, so the command layouts below are
+# precompiled structs that say so explicitly with '>'. every layout includes
+# the length and command name header.
 
 
 class Message(object):
@@ -214,8 +220,39 @@ class Dsco(Message):
 ### COMMANDS ###################################################################
 
 class Command(object):
+	layout = None # struct.Struct for the fixed size part of the command
+
+	# subclasses implement values() to return the tuple of values that fit
+	# in the layout, in order, starting with the length field. the length
+	# doesn't count the length field itself and is passed in by the caller.
+	# commands that end with a variable length part (the Strm GET request or
+	# the Grfe bitmap) also implement tail().
+	def values(self, length):
+		raise Exception, 'All Command subclasses must implement values()'
+
+	def tail(self):
+		return ''
+
 	def serialize(self):
-		raise Exception, 'All Command subclasses must implement serialize()'
+		tail = self.tail()
+		length = self.layout.size - 2 + len(tail)
+		if tail:
+			return self.layout.pack(*self.values(length)) + tail
+		return self.layout.pack(*self.values(length))
+
+	# the number of bytes that serialize() returns
+	def size(self):
+		return self.layout.size + len(self.tail())
+
+	# serialize into a preallocated buffer. returns the offset just after the
+	# serialized command.
+	def pack_into(self, buffer, offset):
+		tail = self.tail()
+		length = self.layout.size - 2 + len(tail)
+		self.layout.pack_into(buffer, offset, *self.values(length))
+		offset += self.layout.size
+		buffer[offset:offset + len(tail)] = tail
+		return offset + len(tail)
 	
 class Strm(Command):
 	# the first couple of sections are just named constants to use in the
@@ -318,40 +355,41 @@ class Strm(Command):
 	resource        = None  # string to identify the file/stream on a CM server
 	seek            = 0     # milliseconds
 
-	def serialize(self):
-		cmd = 'strm'
-		tmp = ( self.operation
-		      + self.autostart
-		      + self.format
-		      + self.pcm_sample_size
-		      + self.pcm_sample_rate
-		      + self.pcm_channels
-		      + self.pcm_endianness
-		      + struct.pack('<B', self.in_threshold)
-		      + self.spdif
-		      + struct.pack('<B', self.fade_time)
-		      + self.fade_type
-		      + struct.pack('<B', self.flags)
-		      + struct.pack('<B', self.out_threshold)
-		      + self.reserved
-		      + struct.pack('<HH', socket.htons(self.gain[0]),
-		                           socket.htons(self.gain[1]))
-		      + struct.pack('<H', socket.htons(self.server_port))
-		      + struct.pack('<L', socket.htonl(self.server_ip)) )
-		if len(tmp) != 24:
-			raise Exception, 'strm command not 24 bytes in length'
-		if self.operation == Strm.OP_START:
-			s = 'GET %s?seek=%s HTTP/1.0\r\n' % (self.resource, self.seek)
-			s = s.encode('utf-8')
-			params = tmp + struct.pack('%ds' % len(s), s)
-			# SqueezeCenter does this (on the GET, but it's all the same). why?
-			#if len(params) % 2 != 0:
-			#	params = params + '\n'
-		else:
-			params = tmp
-
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	# header, then 24 bytes of parameters. the GET request follows when the
+	# operation is OP_START.
+	layout = struct.Struct('>H4s7cBcBcBBcHHHL')
+
+	def tail(self):
+		if self.operation != Strm.OP_START:
+			return ''
+		s = 'GET %s?seek=%s HTTP/1.0\r\n' % (self.resource, self.seek)
+		s = s.encode('utf-8')
+		# SqueezeCenter does this (on the GET, but it's all the same). why?
+		#if len(s) % 2 != 0:
+		#	s = s + '\n'
+		return s
+
+	def values(self, length):
+		return (
+			length, 'strm',
+			self.operation,
+			self.autostart,
+			self.format,
+			self.pcm_sample_size,
+			self.pcm_sample_rate,
+			self.pcm_channels,
+			self.pcm_endianness,
+			self.in_threshold,
+			self.spdif,
+			self.fade_time,
+			self.fade_type,
+			self.flags,
+			self.out_threshold,
+			self.reserved,
+			self.gain[0], self.gain[1],
+			self.server_port,
+			self.server_ip
+		)
 
 class StrmStart(Strm):
 	operation = Strm.OP_START
@@ -403,28 +441,30 @@ class StrmSkip(Strm):
 		self.gain = (0, msecs) # there are many uses for this field..
 
 class Grfe(Command):
-	offset     = 0    # only non-zero for the Transporter
+	offset     = 0    # byte offset into the device's frame buffer. used for
+	                  # partial updates and the Transporter's second display
 	transition = None # char
 	distance   = 32   # transition start on the Y-axis. not well understood
 	bitmap     = None # 4 * 320 chars for an SB2/3 display
 
-	def serialize(self):
-		cmd    = 'grfe'
-		params = ( struct.pack('<H', socket.htons(self.offset))
-		         + self.transition
-		         + struct.pack('<B', self.distance)
-		         + self.bitmap )
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sHcB') # followed by the bitmap
+
+	def tail(self):
+		return self.bitmap
+
+	def values(self, length):
+		return (
+			length, 'grfe',
+			self.offset, self.transition, self.distance
+		)
 
 class Grfb(Command):
 	brightness = None # uint16
 
-	def serialize(self):
-		cmd    = 'grfb'
-		params = struct.pack('<H', socket.htons(self.brightness))
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sH')
+
+	def values(self, length):
+		return (length, 'grfb', self.brightness)
 
 class Aude(Command):
 	# what to enable/disable? true/false
@@ -436,12 +476,10 @@ class Aude(Command):
 		self.analog  = analog
 		self.digital = digital
 
-	def serialize(self):
-		cmd    = 'aude'
-		params = ( struct.pack('<B', self.analog)
-		         + struct.pack('<B', self.digital) )
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sBB')
+
+	def values(self, length):
+		return (length, 'aude', self.analog, self.digital)
 
 class Audg(Command):
 	# gain is represented as (16bit,16bit) fixed point floats. in practice it
@@ -473,22 +511,21 @@ class Audg(Command):
 			gain = int(multiplier * 65536.0 + 0.5)
 		return gain
 
-	def serialize(self):
-		# note that the packing order of the left/right fields really ARE
-		# big-endian. it's not a mistake!
-		cmd    = 'audg'
-		params = ( self.legacy
-		       + struct.pack('<BB', self.dvc, self.preamp)
-		       + struct.pack('>LL', self.left, self.right) )
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	# note that the left/right fields really ARE big-endian, like everything
+	# else in the layout. it's not a mistake!
+	layout = struct.Struct('>H4s8sBBLL')
+
+	def values(self, length):
+		return (
+			length, 'audg', self.legacy, self.dvc, self.preamp,
+			self.left, self.right
+		)
 
 class Updn(Command):
-	def serialize(self):
-		cmd    = 'updn'
-		params = ' '
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sc')
+
+	def values(self, length):
+		return (length, 'updn', ' ')
 
 class Visu(Command):
 	# kinds
@@ -509,16 +546,14 @@ class Visu(Command):
 	def __ne__(self, other):
 		return not self.__eq__(other)
 
-	def serialize(self):
+	def values(self, length):
 		raise Exception, 'Visu must be subclassed'
 
 class VisuNone(Visu):
-	def serialize(self):
-		cmd = 'visu'
-		params = ( struct.pack('<B', Visu.NONE)
-		         + struct.pack('<B', 0) )
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sBB')
+
+	def values(self, length):
+		return (length, 'visu', Visu.NONE, 0)
 
 class VisuMeter(Visu):
 	# style
@@ -542,18 +577,18 @@ class VisuMeter(Visu):
 		self.right_pos   = right_pos
 		self.right_width = right_width
 
-	def serialize(self):
-		cmd = 'visu'
-		params = ( struct.pack('<B', Visu.VUMETER)
-		         + struct.pack('<B', self.PARAMETERS)
-		         + struct.pack('<l', socket.htonl(self.channels))
-		         + struct.pack('<l', socket.htonl(self.style))
-		         + struct.pack('<l', socket.htonl(self.left_pos))
-		         + struct.pack('<l', socket.htonl(self.left_width))
-		         + struct.pack('<l', socket.htonl(self.right_pos))
-		         + struct.pack('<l', socket.htonl(self.right_width)) )
-		length = struct.pack('<h', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sBB6l')
+
+	def values(self, length):
+		return (
+			length, 'visu', Visu.VUMETER, self.PARAMETERS,
+			self.channels,
+			self.style,
+			self.left_pos,
+			self.left_width,
+			self.right_pos,
+			self.right_width
+		)
 
 class VisuSpectrum(Visu):
 	# bandwidth
@@ -598,43 +633,42 @@ class VisuSpectrum(Visu):
 	right_bar_intensity = MILD
 	right_cap_intensity = HOT
 
-	def serialize(self):
-		cmd = 'visu'
-		params = ( struct.pack('<B', Visu.SPECTRUM)
-		         + struct.pack('<B', self.PARAMETERS)
-		         + struct.pack('<l', socket.htonl(self.channels))
-		         + struct.pack('<l', socket.htonl(self.bandwidth))
-		         + struct.pack('<l', socket.htonl(self.preemphasis))
-
-		         + struct.pack('<l', socket.htonl(self.left_pos))
-		         + struct.pack('<l', socket.htonl(self.left_width))
-		         + struct.pack('<l', socket.htonl(self.left_orientation))
-		         + struct.pack('<l', socket.htonl(self.left_bar_width))
-		         + struct.pack('<l', socket.htonl(self.left_bar_spacing))
-		         + struct.pack('<l', socket.htonl(self.left_clipping))
-		         + struct.pack('<l', socket.htonl(self.left_bar_intensity))
-		         + struct.pack('<l', socket.htonl(self.left_cap_intensity))
-
-		         + struct.pack('<l', socket.htonl(self.right_pos))
-		         + struct.pack('<l', socket.htonl(self.right_width))
-		         + struct.pack('<l', socket.htonl(self.right_orientation))
-		         + struct.pack('<l', socket.htonl(self.right_bar_width))
-		         + struct.pack('<l', socket.htonl(self.right_bar_spacing))
-		         + struct.pack('<l', socket.htonl(self.right_clipping))
-		         + struct.pack('<l', socket.htonl(self.right_bar_intensity))
-		         + struct.pack('<l', socket.htonl(self.right_cap_intensity)) )
-		length = struct.pack('<h', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4sBB19l')
+
+	def values(self, length):
+		return (
+			length, 'visu', Visu.SPECTRUM, self.PARAMETERS,
+			self.channels,
+			self.bandwidth,
+			self.preemphasis,
+
+			self.left_pos,
+			self.left_width,
+			self.left_orientation,
+			self.left_bar_width,
+			self.left_bar_spacing,
+			self.left_clipping,
+			self.left_bar_intensity,
+			self.left_cap_intensity,
+
+			self.right_pos,
+			self.right_width,
+			self.right_orientation,
+			self.right_bar_width,
+			self.right_bar_spacing,
+			self.right_clipping,
+			self.right_bar_intensity,
+			self.right_cap_intensity
+		)
 
 class Ping(Command):
 	# there is no command to explicitly poll a device for liveness, but the
 	# 'stat' command works fine for this purpose. will receive back a STAT
 	# message with .event=='stat'.
-	def serialize(self):
-		cmd    = 'stat'
-		params = ''
-		length = struct.pack('<H', socket.htons(len(cmd + params)))
-		return length + cmd + params
+	layout = struct.Struct('>H4s')
+
+	def values(self, length):
+		return (length, 'stat')
 
 
 
@@ -659,15 +693,16 @@ class JsonMessage(Message):
 	def dump(self):
 		return { 'guid': self.guid }
 
-	def serialize(self):
-		data   = json.dumps(self.dump())
-		length = struct.pack('<L', socket.htonl(len(data)))
-		return self.head + length + data
+	# 'codec' is one of the codecs in codec.py. JSON if not given.
+	def serialize(self, codec=JSON):
+		data = codec.encode(self.dump())
+		return codec.head + struct.pack('>L', len(data)) + data
 
+	# replies use the codec that was negotiated for the wire, if any
 	def respond(self, errno, errstr, chunk, more, result):
 		if self.wire:
 			msg = JsonResult(self.guid, errno, errstr, chunk, more, result)
-			self.wire.send(msg.serialize())
+			self.wire.send(msg.serialize(self.wire.codec or JSON))
 
 class JsonCall(JsonMessage):
 	method = None # unicode string
@@ -695,18 +730,25 @@ class JsonCall(JsonMessage):
 		return r
 
 # this command is used by a content manager to hail a device manager. There
-# is no reply message class.
+# is no reply message class. the content manager may list the codecs it can
+# decode, most preferred first. the device manager replies with a JsonResult
+# whose result is a dictionary with the name of the codec to use for all
+# further replies on the wire and the largest chunks of Ls and Search results
+# it wants to receive: { 'codec': <name>, 'batch_bytes': <int> }
 class Hail(JsonCall):
 
-	def __init__(self, guid, label, stream_ip, stream_port):
+	def __init__(self, guid, label, stream_ip, stream_port, codecs=None):
 		assert type(label)       == unicode
 		assert type(stream_ip)   == int
 		assert type(stream_port) == int
+		assert (not codecs)      or type(codecs) == list
 		params = {
 			'label'      : label,
 			'stream_ip'  : stream_ip,
 			'stream_port': stream_port
 		}
+		if codecs:
+			params['codecs'] = codecs
 		JsonCall.__init__(self, guid, u'hail', params)
 
 # used by device manager to ask content manager for a listing of the contents
@@ -786,6 +828,12 @@ class GetTerms(JsonCall):
 	def __init__(self, guid):
 		JsonCall.__init__(self, guid, u'get_terms', {})
 
+# used by user interfaces to get statistics about the render pipelines of all
+# connected devices. use JsonResult to reply.
+class GetStats(JsonCall):
+	def __init__(self, guid):
+		JsonCall.__init__(self, guid, u'get_stats', {})
+
 class Search(JsonCall):
 	terms = None
 	
@@ -821,59 +869,42 @@ class JsonResult(JsonMessage):
 		})
 		return r
 
-def parse_json(data):
-	body = json.loads(data)
+# JSON method name -> JsonCall subclass
+json_methods = {
+	u'hail'     : Hail,
+	u'ls'       : Ls,
+	u'terms'    : Terms,
+	u'play'     : Play,
+	u'add'      : Add,
+	u'get_item' : GetItem,
+	u'search'   : Search,
+	u'get_terms': GetTerms,
+	u'get_stats': GetStats
+}
+
+# turn a decoded message body into a JsonMessage instance
+def make_json_message(body):
 	method = body['method']
-	guid = body['guid']
 
 	if method == u'result':
 		del body['method']
 		return JsonResult(**body)
-	
-	else:
-		params = body['params']	
-
-		if method == u'hail':
-			return Hail(guid, **params)
-	
-		if method == u'ls':
-			return Ls(guid, **params)
-	
-		if method == u'terms':
-			return Terms(guid, **params)
-
-		if method == u'play':
-			return Play(guid, **params)
-		
-		if method == u'add':
-			return Add(guid, **params)
-
-		if method == u'get_item':
-			return GetItem(guid, **params)
-
-		if method == u'terms':
-			return Terms(guid, **params)
-
-		if method == u'search':
-			return Search(guid, **params)
-		
-		if method == u'get_terms':
-			return GetTerms(guid, **params)
-
-	return None
-
-
 
+	try:
+		cls = json_methods[method]
+	except KeyError:
+		return None
+	return cls(body['guid'], **body['params'])
 
+def parse_json(data):
+	return make_json_message(JSON.decode(data))
 
 # only used to debug malformed messages
 def parsable(data):
-	kind = data[0:4]
-	if kind not in ['HELO', 'ANIC', 'IR  ', 'BYE!', 'STAT', 'RESP', 'UREQ',
-	                'JSON']:
+	(kind, size) = HEADER.unpack_from(data)
+	if kind not in parsers:
 		return False
-	blen = socket.ntohl(struct.unpack('<L', data[4:8])[0])
-	if blen > len(data) - 8:
+	if size > len(data) - 8:
 		return False
 	return True
 
@@ -894,98 +925,88 @@ def first_unprintable(data):
 			return i
 	return len(data)
 
-def parse_header(head):
+# the parsers below take the message body as a memoryview into the wire's
+# inbox and decode the fixed size messages with precompiled layouts, without
+# copying the body first. a parser must not let any references to the view
+# escape into the message it returns.
+
+# message kind and body size. the size is in network order.
+HEADER = struct.Struct('>4sL')
+
+def parse_header(head, offset=0):
 	try:
-		kind = head[0:4]
-		if kind not in ['HELO', 'ANIC', 'IR  ', 'BYE!', 'STAT', 'RESP',
-		                'UREQ', 'JSON', 'DSCO']:
+		(kind, size) = HEADER.unpack_from(head, offset)
+		if kind not in parsers:
 			#print('ERROR: unknown header kind %s' % kind)
 			return (None, 0)
-		size = socket.ntohl(struct.unpack('<L', head[4:8])[0])
 		return (kind, size)
 	except Exception, e:
 		print e
 		return (None, 0)
 
 def parse_body(kind, size, body):
-	if kind == 'HELO':
-		if size == 10:
-			msg = parse_helo_10(body, size)
-		elif size == 36:
-			msg = parse_helo_36(body, size)
-		return msg
-
-	if kind == 'ANIC':
-		return Anic()
-
-	if kind == 'IR  ':
-		return parse_ir(body, size)
-
-	if kind == 'BYE!':
-		return parse_bye(body, size)
-	
-	if kind == 'STAT':
-		return parse_stat(body, size)
-
-	if kind == 'RESP':
-		return parse_resp(body, size)
-
-	if kind == 'UREQ':
-		return parse_ureq(body, size)
-
-	if kind == 'JSON':
-		return parse_json(body)
-	
-	if kind == 'DSCO':
-		return parse_dsco(body, size)
-
-	print('unknown message, len %d. first 160 chars:' % size)
-	print(human_readable(body))
-	#sys.exit(1)
-	# look for next message in the mess:
-	#for i in range(len(data) - 4):
-	#	if parsable(data[i:]):
-	#		print('Recovered parsable message')
-	#		return (None, data[i:])
+	try:
+		parser = parsers[kind]
+	except KeyError:
+		print('unknown message, len %d. first 160 chars:' % size)
+		print(human_readable(as_string(body)))
+		return None
+	return parser(body, size)
+
+def as_string(data):
+	if type(data) == memoryview:
+		return data.tobytes()
+	return data
+
+def parse_helo(data, dlen):
+	if dlen == 10:
+		return parse_helo_10(data, dlen)
+	elif dlen == 36:
+		return parse_helo_36(data, dlen)
 	return None
 
+HELO_10 = struct.Struct('>BB6BH')
+
 def parse_helo_10(data, dlen):
-	id       = ord(data[0])
-	revision = ord(data[1])
-	tmp      = struct.unpack('<6BH', data[2:])
-	mac_addr = tuple(tmp[0:6])
-	wlan_chn = socket.ntohs(tmp[6])
-	mac_addr = '%02x:%02x:%02x:%02x:%02x:%02x' % mac_addr
+	tmp      = HELO_10.unpack_from(data)
+	id       = tmp[0]
+	revision = tmp[1]
+	mac_addr = '%02x:%02x:%02x:%02x:%02x:%02x' % tmp[2:8]
+	wlan_chn = tmp[8]
 
 	return Helo(id, revision, mac_addr, 1234, 'EN')
 
+HELO_36 = struct.Struct('>BB6B16BHLL2s')
+
 def parse_helo_36(data, dlen):
-	id       = ord(data[0])
-	revision = ord(data[1])
-	tmp      = struct.unpack('<6B16BHLL2s', data[2:])
-	mac_addr = tuple(tmp[0:6])
+	tmp      = HELO_36.unpack_from(data)
+	id       = tmp[0]
+	revision = tmp[1]
+	mac_addr = tmp[2:8]
 
 	# why not just cook a new device number?
 	if id == ID.SQUEEZEBOX2 and mac_addr[0:3] == (0x0,0x4,0x20):
 		id = ID.SQUEEZEBOX3
 
-	uuid     = ''.join(str(i) for i in tmp[6:22])
-	wlan_chn = socket.ntohs(tmp[22])
-	recv_hi  = socket.ntohl(tmp[23])
-	recv_lo  = socket.ntohl(tmp[24])
-	language = tmp[25]
+	uuid     = ''.join(str(i) for i in tmp[8:24])
+	wlan_chn = tmp[24]
+	recv_hi  = tmp[25]
+	recv_lo  = tmp[26]
+	language = tmp[27]
 	mac_addr = '%02x:%02x:%02x:%02x:%02x:%02x' % mac_addr
 
 	return Helo(id, revision, mac_addr, uuid, language)
 
+def parse_anic(data, dlen):
+	return Anic()
+
+IR_LAYOUT = struct.Struct('>LBBL')
+
 last_ir = None # tuple: (IR code, time stamp, stress)
 def parse_ir(data, dlen):
 	global last_ir
 
-	stamp   = socket.ntohl(struct.unpack('<L', data[0:4])[0])
-	format  = struct.unpack('<B', data[4:5])[0]
-	nr_bits = struct.unpack('<B', data[5:6])[0]
-	code    = socket.ntohl(struct.unpack('<L', data[6:10])[0])
+	(stamp, format, nr_bits, code) = IR_LAYOUT.unpack_from(data)
 	
 	if code not in IR.codes_debug:
 		print('stamp   %d' % stamp)
@@ -1013,30 +1034,34 @@ def parse_ir(data, dlen):
 	last_ir = (code, stamp, stress)
 	return Tactile(code, stress)
 
+REASON = struct.Struct('>B')
+
 def parse_bye(data, dlen):
-	reason = struct.unpack('<B', data[0])
+	reason = REASON.unpack_from(data)[0]
 	return Bye(reason)
 
+STAT_LAYOUT = struct.Struct('>4sBBBLLLLHLLLLHLLH')
+
 def parse_stat(data, dlen):
 	stat = Stat()
 
-	stat.event    = data[0:4]
-	stat.crlfs    = struct.unpack('<B', data[4])[0]
-	stat.mas_init = struct.unpack('<B', data[5])[0]
-	stat.mas_mode = struct.unpack('<B', data[6])[0]
-	stat.in_size  = socket.ntohl(struct.unpack('<L', data[ 7:11])[0])
-	stat.in_fill  = socket.ntohl(struct.unpack('<L', data[11:15])[0])
-	stat.recv_hi  = socket.ntohl(struct.unpack('<L', data[15:19])[0])
-	stat.recv_lo  = socket.ntohl(struct.unpack('<L', data[19:23])[0])
-	stat.wifi_pow = socket.ntohs(struct.unpack('<H', data[23:25])[0])
-	stat.jiffies  = socket.ntohl(struct.unpack('<L', data[25:29])[0])
-	stat.out_size = socket.ntohl(struct.unpack('<L', data[29:33])[0])
-	stat.out_fill = socket.ntohl(struct.unpack('<L', data[33:37])[0])
-	stat.seconds  = socket.ntohl(struct.unpack('<L', data[37:41])[0])
-	stat.voltage  = socket.ntohs(struct.unpack('<H', data[41:43])[0])
-	stat.msecs    = socket.ntohl(struct.unpack('<L', data[43:47])[0])
-	stat.stamp    = socket.ntohl(struct.unpack('<L', data[47:51])[0])
-	stat.error    = socket.ntohl(struct.unpack('<H', data[51:53])[0])
+	( stat.event,
+	  stat.crlfs,
+	  stat.mas_init,
+	  stat.mas_mode,
+	  stat.in_size,
+	  stat.in_fill,
+	  stat.recv_hi,
+	  stat.recv_lo,
+	  stat.wifi_pow,
+	  stat.jiffies,
+	  stat.out_size,
+	  stat.out_fill,
+	  stat.seconds,
+	  stat.voltage,
+	  stat.msecs,
+	  stat.stamp,
+	  stat.error ) = STAT_LAYOUT.unpack_from(data)
 
 	return stat
 
@@ -1044,12 +1069,32 @@ def parse_resp(data, dlen):
 	# data is always an HTTP header. In fact the very same one we sent
 	# on the streaming socket, unless the device is streaming from some
 	# other source.
-	return Resp(data)
+	return Resp(as_string(data))
 
 def parse_ureq(data, dlen):
 	return Ureq()
 
+def parse_json_body(data, dlen):
+	return make_json_message(JSON.decode(data))
+
+def parse_msgpack_body(data, dlen):
+	return make_json_message(MSGPACK.decode(data))
+
 def parse_dsco(data, dlen):
-	reason = struct.unpack('<B', data[0])[0]
+	reason = REASON.unpack_from(data)[0]
 	return Dsco(reason)
 
+# message kind -> parser
+parsers = {
+	'HELO': parse_helo,
+	'ANIC': parse_anic,
+	'IR  ': parse_ir,
+	'BYE!': parse_bye,
+	'STAT': parse_stat,
+	'RESP': parse_resp,
+	'UREQ': parse_ureq,
+	'JSON': parse_json_body,
+	'DSCO': parse_dsco
+}
+if MSGPACK:
+	parsers[MSGPACK.head] = parse_msgpack_body
@@ -0,0 +1,117 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# bounded message queues that keep track of how they are used. every thread in
+# dwite and conman talks to the others through queues, so this is where
+# messages pile up when some part of the system can't keep up. a queue counts
+# the messages that pass through it, remembers how full it has been, and times
+# how long messages wait in it and how long senders are blocked on it.
+#
+# what happens when a queue is full is decided per message by the queue's
+# policy function. the default is to block the sender, like a plain Queue.
+# messages that are only useful when fresh (e.g. display frames) can be dropped
+# instead. put() returns False if the message was dropped.
+#
+# the capacities can be changed with a "queues" dictionary at the top level of
+# dwite.json or conman.json: queue name -> capacity.
+
+from Queue     import Queue, Full
+from threading import Lock
+from weakref   import WeakSet
+from time      import time
+
+from profiler import Histogram
+
+BLOCK = 0
+DROP  = 1
+
+capacities = {}        # queue name -> capacity, from the settings
+registry   = WeakSet() # all live MeteredQueue instances
+lock       = Lock()    # protects the registry
+
+def configure(settings):
+	capacities.update(settings)
+
+class MeteredQueue(Queue):
+	name       = None # unicode string
+	policy     = None # function: message -> BLOCK or DROP. None means BLOCK
+	high_water = 0    # the most messages the queue has held at once
+	puts       = 0    # number of messages put
+	gets       = 0    # number of messages taken
+	dropped    = 0    # number of messages dropped because the queue was full
+	waits      = None # Histogram: time blocked in put() on a full queue
+	latency    = None # Histogram: time from put() to get() for every message
+
+	# the capacity in the settings, if any, overrides 'maxsize'
+	def __init__(self, name, maxsize=0, policy=None):
+		Queue.__init__(self, capacities.get(name, maxsize))
+		self.name    = name
+		self.policy  = policy
+		self.waits   = Histogram()
+		self.latency = Histogram()
+		lock.acquire()
+		registry.add(self)
+		lock.release()
+
+	def put(self, item, block=True, timeout=None):
+		try:
+			Queue.put(self, item, False)
+			return True
+		except Full:
+			if self.policy and self.policy(item) == DROP:
+				self.mutex.acquire()
+				self.dropped += 1
+				self.mutex.release()
+				return False
+			if not block:
+				raise
+		then = time()
+		Queue.put(self, item, True, timeout)
+		self.mutex.acquire()
+		self.waits.add(max(time() - then, 0) * 1000)
+		self.mutex.release()
+		return True
+
+	# the underscore methods are called by Queue with self.mutex held. every
+	# message is stored with the time at which it was put. the wall clock is
+	# good enough for statistics and a lot cheaper than clock.monotonic().
+	def _put(self, item):
+		self.queue.append((item, time()))
+		self.puts += 1
+		if len(self.queue) > self.high_water:
+			self.high_water = len(self.queue)
+
+	def _get(self):
+		(item, then) = self.queue.popleft()
+		self.gets += 1
+		self.latency.add(max(time() - then, 0) * 1000)
+		return item
+
+	def dump(self):
+		self.mutex.acquire()
+		try:
+			return {
+				'name'      : self.name,
+				'capacity'  : self.maxsize,
+				'size'      : len(self.queue),
+				'high_water': self.high_water,
+				'puts'      : self.puts,
+				'gets'      : self.gets,
+				'dropped'   : self.dropped,
+				'waits'     : self.waits.dump(),
+				'latency'   : self.latency.dump()
+			}
+		finally:
+			self.mutex.release()
+
+# statistics for all live queues, sorted by name
+def dump():
+	lock.acquire()
+	try:
+		queues = list(registry)
+	finally:
+		lock.release()
+	return sorted([q.dump() for q in queues], key=lambda d: d['name'])
@@ -0,0 +1,104 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# captures the raw bytes that wires send and receive, so that real traffic can
+# be replayed later without any devices or content managers (see "bench
+# replay"). enable it by setting e.g. "recording": "/tmp/dwite.rec" at the top
+# level of dwite.json. all wires in the process write to the same file.
+#
+# the file starts with a 6 byte header (magic and version), followed by one
+# record per event. every record has a 17 byte header of its own: wall clock
+# time, connection number, event and payload length. the payload of an OPEN
+# record is the name of the wire's class and its port, e.g. "SlimWire 3483".
+# IN and OUT records hold exactly the bytes that were read from or written to
+# the socket, so a message may be split over several records and a record may
+# hold several messages.
+
+import struct
+
+from threading import Lock
+from time      import time
+
+MAGIC   = 'DWTR'
+VERSION = 1
+HEAD    = struct.Struct('>4sH')
+RECORD  = struct.Struct('>dLBL') # time, connection, event, payload length
+
+OPEN  = 0 # a wire was connected
+IN    = 1 # bytes received
+OUT   = 2 # bytes sent
+CLOSE = 3 # the wire was closed
+
+class Recorder(object):
+	path        = None
+	file        = None
+	lock        = None # the reactor thread writes, the main thread closes
+	connections = 0    # the number of connections recorded so far
+
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'wb')
+		self.lock = Lock()
+		self.file.write(HEAD.pack(MAGIC, VERSION))
+
+	# returns the connection number to use for all records about the wire
+	def open(self, name, port):
+		self.lock.acquire()
+		try:
+			self.connections += 1
+			connection = self.connections
+		finally:
+			self.lock.release()
+		self.write(connection, OPEN, '%s %d' % (name, port))
+		return connection
+
+	# 'data' is a string, buffer or bytearray
+	def write(self, connection, event, data):
+		self.lock.acquire()
+		try:
+			if not self.file:
+				return # closed while the reactor was still running
+			self.file.write(RECORD.pack(time(), connection, event, len(data)))
+			self.file.write(data)
+			if event == CLOSE:
+				self.file.flush()
+		finally:
+			self.lock.release()
+
+	def close(self):
+		self.lock.acquire()
+		try:
+			if self.file:
+				self.file.close()
+				self.file = None
+		finally:
+			self.lock.release()
+
+# returns a list of (time, connection, event, payload) tuples. a record that was
+# cut short because dwite died while writing it is ignored.
+def load(path):
+	f = open(path, 'rb')
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	if len(data) < HEAD.size:
+		raise Exception, '%s is not a recording' % path
+	(magic, version) = HEAD.unpack_from(data)
+	if magic != MAGIC:
+		raise Exception, '%s is not a recording' % path
+	if version != VERSION:
+		raise Exception, 'Unsupported recording version %d' % version
+	records = []
+	offset  = HEAD.size
+	while len(data) - offset >= RECORD.size:
+		(stamp, connection, event, size) = RECORD.unpack_from(data, offset)
+		offset += RECORD.size
+		if len(data) - offset < size:
+			break
+		records.append((stamp, connection, event, data[offset:offset+size]))
+		offset += size
+	return records
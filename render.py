@@ -8,26 +8,31 @@ import os
 import sys
 import traceback
 
-from datetime import datetime, timedelta
+from threading import Lock
 
 # PIL dependencies
 import Image, ImageDraw, ImageFont
 
 import fonts
 
+from canvas import pack
+from clock  import monotonic, NEVER
+
 class Render(object):
 	timeout = None
 	mode    = None
 	image   = None
 	timeout = None
+	frame   = None # [image, packed image or None]. see packed()
 
 	def __init__(self):
-		self.timeout = datetime.now()
+		self.timeout = monotonic()
 
 	# Render objects keep track of their internal frame rate by setting a
-	# timeout (in absolute wall clock time) at which the next frame should
-	# be drawn. it should expect that a user of the object calls its tick()
-	# method regularly to drive this.
+	# timeout (in monotonic time, see clock.py) at which the next frame should
+	# be drawn. renders that have nothing more to draw until they are curried
+	# again set the timeout to NEVER. users of the object should call tick()
+	# when deadline() has passed to drive this.
 
 	def dump(self):
 		raise Exception('Render sub-classes must implement dump()')
@@ -35,38 +40,58 @@ class Render(object):
 	def draw(self):
 		raise Exception('Render sub-classes must implement draw()')
 
-	# subclasses must implement the curry() method
+	# subclasses must implement the curry() method. they must also call this
+	# implementation to wake up the render if it was idle.
 	def curry(self):
-		pass
+		if self.timeout == NEVER:
+			self.timeout = monotonic()
 
 	# subclasses must implement the tick() method
 	def tick(self, canvas, force=False):
 		if self.expired(force):
 			self.image = Image.new('1', canvas.size, 0)
 			self.draw()
-			self.timeout = datetime.now() + timedelta(milliseconds=100)
+			self.timeout = NEVER # nothing more to draw until curried again
 			return True
 		return False
 
 	def min_timeout(self, msecs):
-		test = datetime.now() + timedelta(milliseconds=msecs)
+		test = monotonic() + msecs / 1000.0
 		if test > self.timeout:
 			self.timeout = test
 
+	# the monotonic time at which tick() should be called next
+	def deadline(self):
+		if self.timeout == None:
+			return 0.0
+		return self.timeout
+
 	# subclasses that have different display should look at self.mode
 	def	next_mode(self):
 		pass
 
+	# renders that cover the whole canvas on their own may return their image
+	# in packed form (see canvas.pack()). this saves the canvas the trouble of
+	# compositing and packing it again for every frame. the packed image is
+	# made on demand and then remembered in self.frame for as long as that
+	# frame is reused.
+	def packed(self):
+		if not self.frame or self.frame[0] is not self.image:
+			return None
+		if self.frame[1] == None:
+			self.frame[1] = pack(self.frame[0])
+		return self.frame[1]
+
 	def expired(self, force):
 		if force:
 #			sys.stdout.write('X')
 #			sys.stdout.flush()
 			return True
-		if not self.timeout:
+		if self.timeout == None:
 #			sys.stdout.write('Q')
 #			sys.stdout.flush()
 			return True
-		if self.timeout < datetime.now():
+		if self.timeout <= monotonic():
 #			sys.stdout.write('v')
 #			sys.stdout.flush()
 			return True
@@ -101,16 +126,86 @@ class Window(object):
 			self.current = self.current - amount
 		return self.get()
 
+# text renders spend most of their time in FreeType if the text is drawn again
+# for every frame. that is especially wasteful when scrolling long texts, which
+# only moves the same pixels around. instead, each text is rasterized once into
+# a "strip" that is just wide enough to hold it. drawing a frame then becomes a
+# matter of pasting the strip at the right position(s).
+#
+# the strips are kept in a cache that is shared by all text renders. it evicts
+# the least recently used strips when the total size goes above the budget (in
+# bytes of 1-bit pixel data).
+class StripCache(object):
+	budget = 0    # bytes
+	used   = 0    # bytes
+	strips = None # dictionary: key -> [strip image, size in bytes, last use]
+	clock  = 0    # incremented on every lookup. used to find the LRU strip
+	lock   = None # strips are shared by all device threads
+
+	def __init__(self, budget):
+		self.budget = budget
+		self.strips = {}
+		self.lock   = Lock()
+
+	def get(self, key, rasterize):
+		self.lock.acquire()
+		try:
+			self.clock += 1
+			if key in self.strips:
+				entry = self.strips[key]
+				entry[2] = self.clock
+				return entry[0]
+		finally:
+			self.lock.release()
+
+		# don't hold the lock while rasterizing. worst case is that two
+		# threads rasterize the same strip at the same time.
+		strip = rasterize()
+		cost  = (strip.size[0] + 7) / 8 * strip.size[1]
+		self.lock.acquire()
+		try:
+			if key not in self.strips:
+				self.strips[key] = [strip, cost, self.clock]
+				self.used += cost
+			while self.used > self.budget and len(self.strips) > 1:
+				lru = min(self.strips, key=lambda k: self.strips[k][2])
+				self.used -= self.strips[lru][1]
+				del self.strips[lru]
+		finally:
+			self.lock.release()
+		return strip
+
+	def dump(self):
+		return {
+			'strips': len(self.strips),
+			'used'  : self.used,
+			'budget': self.budget
+		}
+
+strips = StripCache(2 * 1024 * 1024)
+
+# space around the text in a strip, in pixels, so that glyphs that stick out a
+# bit on either side of the text's nominal size are not cut off.
+STRIP_MARGIN = 4
+
+# scrolling with a sliding window is periodic, so every frame of a scroll cycle
+# is drawn (and packed) only once and then replayed from a cache of frames. the
+# cache is limited to this many frames per render.
+MAX_FRAMES = 512
+
 singleton = {}
 
 class TextRender(Render):
 	font     = None
+	font_path = None
+	font_size = 0
 	text     = None
 	window   = None
 	timeout  = None
 	position = (0, 0)
 	scroll   = True
 	positions = None
+	frames   = None # dictionary: (canvas size, positions) -> frame
 
 	def __new__(cls, font_path, size, position, scroll=True):
 		global singleton
@@ -124,14 +219,17 @@ class TextRender(Render):
 		return obj
 
 	def __init__(self, font_path, size, position, scroll=True):
-		self.font     = ImageFont.truetype(font_path, size)
-		self.position = position
-		self.scroll   = scroll
+		self.font      = ImageFont.truetype(font_path, size)
+		self.font_path = font_path
+		self.font_size = size
+		self.position  = position
+		self.scroll    = scroll
 
 	def curry(self, text):
 		assert type(text) == unicode
 		self.text    = text
 		self.window  = False
+		self.frames  = {}
 		Render.curry(self)
 
 	def dump(self):
@@ -141,16 +239,36 @@ class TextRender(Render):
 			'id'  : id(self)
 		}
 
+	# identifies the rasterized text in the strip cache
+	def strip_key(self):
+		return (self.font_path, self.font_size, self.text)
+
+	# only called on strip cache misses
+	def rasterize(self):
+		(w, h) = self.font.getsize(self.text)
+		strip  = Image.new(
+			'1', (w + 2 * STRIP_MARGIN, h + 2 * STRIP_MARGIN), 0
+		)
+		draw = ImageDraw.Draw(strip)
+		draw.text((STRIP_MARGIN, STRIP_MARGIN), self.text, font=self.font,
+		          fill=1)
+		return strip
+
+	def get_strip(self):
+		return strips.get(self.strip_key(), self.rasterize)
+
 	def draw(self):
 		assert self.image
-		draw = ImageDraw.Draw(self.image)
+		strip = self.get_strip()
 		for p in self.positions:
-			draw.text(p, self.text, font=self.font, fill=1)
+			# use the strip as its own mask so that the copies of the text in
+			# a wrapping window don't erase each other's margins.
+			box = (p[0] - STRIP_MARGIN, p[1] - STRIP_MARGIN)
+			self.image.paste(1, box + (box[0] + strip.size[0],
+			                           box[1] + strip.size[1]), strip)
 
 	def make_window(self, size):
-		assert self.image
-		draw  = ImageDraw.Draw(self.image)
-		(x,y) = draw.textsize(self.text, font=self.font)
+		x = self.get_strip().size[0] - 2 * STRIP_MARGIN
 		if x > size[0] - self.position[0]:
 			# would render outside image's right side. create a sliding window
 			return Window(size[0], 10, x, self.position[0])
@@ -160,23 +278,38 @@ class TextRender(Render):
 		if not self.expired(force):
 			return False
 		
-		self.timeout = datetime.now() + timedelta(milliseconds=100)
-		self.image = Image.new('1', canvas.size, 0)
 		if self.scroll:
 			if not self.window:
 				self.window  = self.make_window(canvas.size)
-				self.timeout = datetime.now() + timedelta(milliseconds=1000)
+				if self.window:
+					# pause a little before starting to scroll
+					self.timeout = monotonic() + 1.0
+				else:
+					self.timeout = NEVER # fits on the display. no scrolling
 				self.positions = [self.position]
 			else:
 				positions = self.window.advance(5)
 				self.positions = [(p, self.position[1]) for p in positions]
+				self.timeout   = monotonic() + 0.1
 		else:
 			self.positions = [self.position]
-		self.draw()
+			self.timeout   = NEVER
+
+		key = (canvas.size, tuple(self.positions))
+		if key in self.frames:
+			self.frame = self.frames[key]
+		else:
+			self.image = Image.new('1', canvas.size, 0)
+			self.draw()
+			self.frame = [self.image, None]
+			if len(self.frames) < MAX_FRAMES:
+				self.frames[key] = self.frame
+		self.image = self.frame[0]
 		return True
 
 class HighlightTextRender(TextRender):
 	regular_font = None
+	regular_path = None
 	bold_font    = None
 	bold_len     = 0
 	
@@ -197,6 +330,7 @@ class HighlightTextRender(TextRender):
 		TextRender.__init__(self, bold_path, size, position, scroll)
 		self.bold_font    = self.font
 		self.regular_font = ImageFont.truetype(regular_path, size)
+		self.regular_path = regular_path
 
 	def dump(self):
 		return {
@@ -206,19 +340,25 @@ class HighlightTextRender(TextRender):
 			'id'  : id(self)
 		}
 
-	def draw(self):
-		assert self.image
-		draw = ImageDraw.Draw(self.image)
-		for p in self.positions:
-			# first draw the bold text. then check how much space that took
-			# on the X axis...
-			b_text = self.text[:self.bold_len].upper()
-			draw.text(p, b_text, font=self.bold_font, fill=1)
-			(w, h) = draw.textsize(b_text, font=self.bold_font)
-			# ...and add that to an infered starting position for regular text
-			p2 = (p[0]+w, p[1])
-			r_text = self.text[self.bold_len:]
-			draw.text(p2, r_text, font=self.regular_font, fill=1)
+	def strip_key(self):
+		return (self.font_path, self.regular_path, self.font_size,
+		        self.bold_len, self.text)
+
+	def rasterize(self):
+		b_text = self.text[:self.bold_len].upper()
+		r_text = self.text[self.bold_len:]
+		(bw, bh) = self.bold_font.getsize(b_text)
+		(rw, rh) = self.regular_font.getsize(r_text)
+		strip = Image.new(
+			'1', (bw + rw + 2 * STRIP_MARGIN, max(bh, rh) + 2 * STRIP_MARGIN), 0
+		)
+		draw = ImageDraw.Draw(strip)
+		# first draw the bold text, then add the space that took on the X axis
+		# to an infered starting position for regular text.
+		p = (STRIP_MARGIN, STRIP_MARGIN)
+		draw.text(p, b_text, font=self.bold_font, fill=1)
+		draw.text((p[0] + bw, p[1]), r_text, font=self.regular_font, fill=1)
+		return strip
 	
 	def curry(self, text, bold_len=0):
 		assert type(text) == unicode
@@ -302,6 +442,7 @@ class ProgressRender(Render):
 	y_size   = 2
 	position = (200, 0)
 	image    = None
+	drawn    = None # (canvas size, filled pixels) of the current image
 
 	# __new__() should not be implemented to use singletons. If there is only
 	# one, then there is a race condition between seeking and playback. Regular
@@ -323,6 +464,19 @@ class ProgressRender(Render):
 		Render.curry(self)
 		self.progress = progress
 
+	def tick(self, canvas, force=False):
+		if not self.expired(force):
+			return False
+		# progress usually changes too little to move the bar by a whole pixel
+		# between two ticks. only draw a new image when it does.
+		drawn = (canvas.size, int(self.x_size * self.progress))
+		if drawn != self.drawn:
+			self.image = Image.new('1', canvas.size, 0)
+			self.draw()
+			self.drawn = drawn
+		self.timeout = NEVER # nothing more to draw until curried again
+		return True
+
 	def draw(self):
 		assert self.image
 		# tl = top left, lr = lower right
@@ -338,8 +492,9 @@ class ProgressRender(Render):
 		draw.rectangle([inner_tl, inner_lr], outline=1, fill=1)
 
 class OverlayRender(Render):
-	base    = None
-	overlay = None
+	base     = None
+	overlay  = None
+	composed = None # (base image, overlay image) that self.image was made of
 
 	def __init__(self, base, overlay):
 		Render.__init__(self)
@@ -362,19 +517,53 @@ class OverlayRender(Render):
 	def tick(self, canvas, force=False):
 		t1 = self.base.tick(canvas, force)
 		t2 = self.overlay.tick(canvas, force)
-		self.draw()
+		self.compose()
 		return t1 or t2
 
+	# renders replace their images instead of drawing on them once they have
+	# been shown, so the identities of the two images tell whether anything
+	# changed since the last composition.
+	def compose(self):
+		key = (self.base.image, self.overlay.image)
+		if (self.composed
+		and self.composed[0] is key[0]
+		and self.composed[1] is key[1]):
+			return
+		self.draw()
+		self.frame    = [self.image, None]
+		self.composed = key
+
 	def min_timeout(self, msecs):
 		self.base.min_timeout(msecs)
 		self.overlay.min_timeout(msecs)
 
+	def deadline(self):
+		return min(self.base.deadline(), self.overlay.deadline())
+
 class NowPlayingRender(OverlayRender):
+	frames = None # dictionary: (base image, overlay image) -> frame
+
 	def __init__(self):
 		item = ItemRender(fonts.get_path('LiberationMono-Bold'), 35, (2,0))
 		item.mode = RENDER_MODE.PRETTY
 		progress = ProgressRender()
 		OverlayRender.__init__(self, item, progress)
+		self.frames = {}
+
+	# the track title scrolls in cycles while the progress bar stays put, so
+	# keep all the compositions instead of just the last one. holding on to
+	# the images in the key also makes sure their identities aren't recycled.
+	def compose(self):
+		key = (self.base.image, self.overlay.image)
+		if key in self.frames:
+			self.frame = self.frames[key]
+		else:
+			self.draw()
+			self.frame = [self.image, None]
+			if len(self.frames) >= MAX_FRAMES:
+				self.frames = {}
+			self.frames[key] = self.frame
+		self.image = self.frame[0]
 
 	def curry(self, progress, item):
 		if item:
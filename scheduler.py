@@ -0,0 +1,130 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+import os
+import select
+import heapq
+import errno
+import fcntl
+
+from threading import Thread, Lock
+from Queue     import Full
+
+from clock import monotonic, NEVER
+
+RUNNING = 1
+STOPPED = 2
+
+# posted to a queue when the deadline that was scheduled for it has passed
+class Tick(object):
+	pass
+
+# instead of having every device thread wake up 50 times per second to check if
+# its renders have anything to draw, each device tells the scheduler when it
+# next needs to be woken up and then blocks on its message queue. the scheduler
+# keeps the deadlines of all devices in a heap and sleeps until the earliest of
+# them, at which point it posts a Tick to the queue of the device that was due.
+# devices that have nothing to draw (e.g. because they are powered off) simply
+# don't schedule anything and won't be woken up at all.
+class Scheduler(Thread):
+	state   = RUNNING
+	heap    = None # [(deadline, sequence number, queue)]
+	pending = None # dictionary: queue -> deadline. the only valid heap entries
+	counter = 0    # sequence number. keeps heap entries unique and ordered
+	lock    = None
+	pipe    = None # (read fd, write fd). used to wake the thread up early
+	ticks   = 0    # number of Ticks posted so far
+	wakeups = 0    # number of times the scheduler thread woke up
+
+	def __init__(self):
+		Thread.__init__(self, name='Scheduler')
+		self.daemon  = True
+		self.heap    = []
+		self.pending = {}
+		self.lock    = Lock()
+		self.pipe    = os.pipe()
+		# never block a scheduling thread just because nobody reads the pipe
+		flags = fcntl.fcntl(self.pipe[1], fcntl.F_GETFL)
+		fcntl.fcntl(self.pipe[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	def stop(self):
+		self.state = STOPPED
+		self.wake()
+
+	def wake(self):
+		try:
+			os.write(self.pipe[1], 'x')
+		except OSError, e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	# replaces whatever deadline was scheduled for the queue before. pass
+	# NEVER to cancel. the deadline is in monotonic time (see clock.py).
+	def schedule(self, queue, deadline):
+		self.lock.acquire()
+		try:
+			if self.pending.get(queue, NEVER) == deadline:
+				return
+			if deadline == NEVER:
+				# the stale heap entry is thrown away when it comes up
+				del self.pending[queue]
+				return
+			self.pending[queue] = deadline
+			self.counter += 1
+			heapq.heappush(self.heap, (deadline, self.counter, queue))
+			earliest = self.heap[0][1] == self.counter
+		finally:
+			self.lock.release()
+		if earliest:
+			# the thread may be sleeping on a later deadline
+			self.wake()
+
+	def dump(self):
+		return {
+			'pending': len(self.pending),
+			'ticks'  : self.ticks,
+			'wakeups': self.wakeups
+		}
+
+	# returns the queues that are due and the number of seconds until the
+	# next deadline (None if there is nothing to wait for).
+	def pop_due(self):
+		due = []
+		now = monotonic()
+		self.lock.acquire()
+		try:
+			while self.heap:
+				(deadline, counter, queue) = self.heap[0]
+				if self.pending.get(queue) != deadline:
+					heapq.heappop(self.heap) # rescheduled or cancelled
+					continue
+				if deadline > now:
+					return (due, deadline - now)
+				heapq.heappop(self.heap)
+				del self.pending[queue]
+				due.append(queue)
+			return (due, None)
+		finally:
+			self.lock.release()
+
+	def run(self):
+		while self.state != STOPPED:
+			(due, timeout) = self.pop_due()
+			for queue in due:
+				try:
+					queue.put(Tick(), block=False)
+					self.ticks += 1
+				except Full:
+					pass # busy device. it will reschedule when it catches up
+			try:
+				(r, w, x) = select.select([self.pipe[0]], [], [], timeout)
+			except select.error, e:
+				if e[0] != errno.EINTR:
+					raise
+				continue
+			self.wakeups += 1
+			if r:
+				os.read(self.pipe[0], 4096) # drain pending wake up calls
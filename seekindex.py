@@ -0,0 +1,238 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# FLAC must be streamed from a frame boundary, so seeking in a FLAC file needs
+# the byte offsets of its frames. finding them means walking every frame of
+# the file with libFLAC, which takes a long time for big files. the offsets
+# are kept in an SQLite database in the configuration directory, keyed by the
+# path of the file and its modification time and size, so every file is only
+# walked once. the offsets are stored as the raw bytes of an array('L').
+#
+# most files don't need to be walked at all because flacseek.py can find their
+# frames by looking at a few frame headers. "conman --scan" checks every FLAC
+# file that is new or has changed since the last scan and walks the ones that
+# flacseek.py can't handle, so that no seek during playback has to. the files
+# that didn't need it are stored without offsets, to remember that they have
+# been checked.
+
+import os
+import sqlite3
+import traceback
+
+import mutagen.flac
+
+from array           import array
+from multiprocessing import Process, Queue, Pool, TimeoutError
+from time            import time
+
+from flac import FlacDecoder, END_OF_STREAM
+
+import flacseek
+
+TYPECODE = 'L'
+PATIENCE = 600.0 # seconds to wait for a file to be checked before giving up
+
+def connect():
+	path = os.path.join(os.environ['DWITE_CFG_DIR'], 'seekindex.sqlite3')
+	db_conn = sqlite3.connect(path)
+	db_conn.execute(
+		'create table if not exists seek_index '
+		'(path text primary key, mtime real, size integer, offsets blob)'
+	)
+	return db_conn
+
+# returns the frame offsets of the file, or None if they haven't been stored
+# or the file has changed since they were. the offsets are empty if the file
+# was checked by prebuild() and didn't need them.
+def load(path, stat):
+	db_conn = connect()
+	try:
+		row = db_conn.execute(
+			'select mtime, size, offsets from seek_index where path=?',
+			(safe_key(path),)
+		).fetchone()
+	finally:
+		db_conn.close()
+	if not row:
+		return None
+	(mtime, size, blob) = row
+	if mtime != stat.st_mtime or size != stat.st_size:
+		return None
+	offsets = array(TYPECODE)
+	if len(blob) % offsets.itemsize:
+		return None # written by a platform with another word size
+	offsets.fromstring(str(blob))
+	return offsets
+
+def store(path, stat, offsets):
+	db_conn = connect()
+	try:
+		insert(db_conn, path, stat, offsets.tostring())
+		db_conn.commit()
+	finally:
+		db_conn.close()
+
+def insert(db_conn, path, stat, data):
+	db_conn.execute(
+		'insert or replace into seek_index values (?,?,?,?)',
+		(safe_key(path), stat.st_mtime, stat.st_size, sqlite3.Binary(data))
+	)
+
+# has the file been indexed since it last changed?
+def fresh(db_conn, path, stat):
+	row = db_conn.execute(
+		'select mtime, size from seek_index where path=?', (safe_key(path),)
+	).fetchone()
+	return row != None and row == (stat.st_mtime, stat.st_size)
+
+# paths of files with unknown encoding may not be valid UTF-8
+def safe_key(path):
+	if type(path) == unicode:
+		return path
+	return path.decode('utf-8', 'replace')
+
+# walk all frames of the file with libFLAC and return their offsets. must not
+# be called from a process with other threads (see build()).
+def walk(path):
+	# path parameter must not be unicode:
+	if type(path) == unicode:
+		path = path.encode('utf-8')
+	dec = FlacDecoder(path)
+	dec.skip_metadata()
+	offsets = array(TYPECODE)
+	while dec.get_state() != END_OF_STREAM:
+		offsets.append(dec.get_position())
+		dec.skip_frame()
+	return offsets
+
+# walk() the file in a process of its own
+def build(path):
+	def target(path, queue):
+		# still don't trust ctypes. install signal handler for
+		# SIGSEGV so we can get out of this process somehow:
+		import signal
+		def handler(signum, frame):
+			print 'FlacDecoder caught SIGSEGV'
+			queue.put(None)
+		signal.signal(signal.SIGSEGV, handler)
+		queue.put(walk(path).tostring())
+
+	# astonishingly, the use of ctypes tends to cause SIGSEGV in libFLAC if
+	# there are enough other threads doing enough other work at the same time.
+	# there is no other thread using libFLAC and yet it will crash if there is
+	# enough other threaded activity going on. running the ctypes stuff from a
+	# process solves the problem:
+	q = Queue()
+	p = Process(target=target, args=(path, q))
+	p.daemon = True
+	p.start()
+	data = q.get()
+	p.terminate()
+	offsets = array(TYPECODE)
+	if data:
+		offsets.fromstring(data)
+	return offsets
+
+# returns the frame offsets of the file at 'path', which is open as 'file'.
+# they are only computed if the index doesn't have them yet.
+def get(path, file):
+	stat = os.fstat(file.fileno())
+	try:
+		offsets = load(path, stat)
+		if offsets:
+			return offsets
+	except Exception, e:
+		traceback.print_exc()
+	offsets = build(path)
+	if offsets:
+		# a failed walk is tried again the next time
+		try:
+			store(path, stat, offsets)
+		except Exception, e:
+			traceback.print_exc()
+	return offsets
+
+# runs in a worker process of prebuild(). returns (key, offsets as a string),
+# where the offsets are empty if flacseek.py can find the frames without them,
+# or None if the file couldn't be checked.
+def check(job):
+	(key, path) = job
+	try:
+		audio = mutagen.flac.FLAC(path)
+		f = open(path, 'rb')
+		try:
+			size = os.fstat(f.fileno()).st_size
+			middle = int(audio.info.length * 500)
+			if flacseek.time_to_offset(audio, f, size, middle) != None:
+				return (key, '')
+		finally:
+			f.close()
+		return (key, walk(path).tostring())
+	except Exception, e:
+		print('WARNING: Could not index %s: %s' % (path, str(e)))
+		return (key, None)
+
+# check all files in 'jobs' that have changed since they were last checked,
+# using a pool of worker processes. 'jobs' is a list of (key, path) tuples,
+# where the key is the path that the streamer will use for the file and the
+# path is where the file really is (they differ for file names that aren't
+# valid UTF-8). progress is printed as the work goes on.
+def prebuild(jobs, processes):
+	db_conn = connect()
+	try:
+		stale = {}
+		for (key, path) in jobs:
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			if not fresh(db_conn, key, stat):
+				stale[key] = (path, stat)
+		print(
+			'Seek index: %d of %d FLAC files are new or have changed'
+			% (len(stale), len(jobs))
+		)
+		if not stale:
+			return
+
+		pool    = Pool(processes)
+		start   = time()
+		report  = start
+		done    = 0
+		walked  = 0
+		# one file per task. with bigger chunks, the result iterator can't
+		# be given a timeout.
+		results = pool.imap_unordered(
+			check, [(key, stale[key][0]) for key in stale]
+		)
+		try:
+			for i in range(len(stale)):
+				# a worker that crashes in libFLAC takes its job with it, so
+				# don't wait forever for the last results.
+				(key, data) = results.next(PATIENCE)
+				done += 1
+				if data != None:
+					insert(db_conn, key, stale[key][1], data)
+					if data:
+						walked += 1
+				now = time()
+				if now - report >= 5.0 or done == len(stale):
+					db_conn.commit()
+					report = now
+					print(
+						'Seek index: %d of %d files checked, %.1f files/s'
+						% (done, len(stale), done / max(now - start, 0.001))
+					)
+		except TimeoutError:
+			print('Seek index: gave up waiting for the last files')
+		finally:
+			pool.terminate()
+		print(
+			'Seek index: %d files had to be walked with libFLAC' % walked
+		)
+	finally:
+		db_conn.commit()
+		db_conn.close()
@@ -10,6 +10,7 @@ import errno
 import re
 import urllib
 import os
+import fcntl
 import traceback
 
 import mutagen
@@ -17,10 +18,12 @@ if not (hasattr(mutagen, 'version') and mutagen.version >= (1,19)):
 	print('Dwite requires at least version 1.19 of Mutagen')
 	sys.exit(1)
 
-from threading       import Thread
-from multiprocessing import Process, Queue
+from threading import Thread
+from Queue     import Queue, Empty
 
-from flac import FlacDecoder, END_OF_STREAM
+import flacseek
+import seekindex
+import zerocopy
 
 STOPPED  = 0
 STARTING = 1
@@ -34,13 +37,164 @@ class Accepting(object):
 		self.host = host
 		self.port = port
 
-# accepts connections to a socket and then feeds data on that socket.
+# one HTTP connection from a device. every stream has its own decoder and thus
+# its own position in its own file.
+class Stream(object):
+	socket   = None
+	backend  = None
+	inbox    = ''    # request data that hasn't been handled yet. None after
+	                 # the request has been handled
+	out_data = None  # the HTTP response, or a chunk of the file if it can't
+	                 # be sent with sendfile()
+	out_left = 0     # bytes at the end of out_data that haven't been sent
+	decoder  = None  # a Decoder object
+	writing  = False # is there anything to write?
+	wanted   = None  # msec to seek to once the decoder has the frame offsets
+	                 # of the file. nothing is streamed until then.
+	indexing = False # is a worker looking for the frame offsets?
+
+	def __init__(self, socket, backend):
+		self.socket  = socket
+		self.backend = backend
+		self.socket.setblocking(False)
+
+	# returns False if the connection is gone
+	def readable(self):
+		try:
+			in_data = self.socket.recv(4096)
+		except socket.error, e:
+			if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+				return True
+			if e[0] != errno.ECONNRESET:
+				print('Streamer recv() failed: %s' % str(e))
+			return False
+		if len(in_data) == 0:
+			return False # the device hung up
+
+		if self.inbox == None:
+			return True # header lines after the request line don't matter
+		self.inbox += in_data
+		if '\r\n' not in self.inbox:
+			return True # the rest of the request line hasn't arrived yet
+		request = self.inbox.split('\r\n', 1)[0]
+		self.inbox = None
+		if not request.startswith('GET '):
+			raise Exception, ( 'streamer got weird stuff to read:\n'
+			                 + 'len=%d\n' % len(request)
+			                 + 'data=%s\n' % request )
+		self.out_data = self.handle_http_get(request.decode('utf-8'))
+		self.out_left = len(self.out_data)
+		self.writing  = True
+		return True
+
+	# returns False if the connection is gone
+	def writable(self):
+		if self.out_left == 0 and self.wanted != None:
+			# the response has been sent but the file can't be streamed
+			# before the decoder knows where to start.
+			self.writing = False
+			return True
+
+		if self.out_left == 0 and self.decoder and zerocopy.sendfile:
+			# the file goes straight from the page cache to the socket
+			# without being read into Python.
+			try:
+				sent = self.decoder.send(self.socket)
+			except Exception, e:
+				if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+					return True
+				if e[0] not in [errno.EPIPE, errno.ECONNRESET]:
+					print('Streamer sendfile() failed: %s' % str(e))
+				return False
+			if sent == 0:
+				self.writing = False # see below
+			return True
+
+		if self.out_left == 0:
+			self.out_data = None
+			if self.decoder:
+				self.out_data = self.decoder.read()
+			if self.out_data:
+				self.out_left = len(self.out_data)
+			else:
+				self.out_left = 0
+				# annoyingly, the socket is always writable when we have
+				# already written everything there is to write. unselect
+				# writable to avoid high CPU utilization.
+				self.writing = False
+			return True
+
+		# send from a view to not copy what is left of the data every time
+		# the socket only takes part of it.
+		try:
+			view = memoryview(self.out_data)[len(self.out_data)-self.out_left:]
+			sent = self.socket.send(view)
+			self.out_left = self.out_left - sent
+		except socket.error, e:
+			if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+				return True
+			if e[0] not in [errno.EPIPE, errno.ECONNRESET]:
+				print('Streamer send() failed: %s' % str(e))
+			return False
+		return True
+
+	def handle_http_get(self, data):
+		# check what resource is requested and whether to start playing it
+		# at some offset:
+		print data.strip()
+		try:
+			m = re.search('GET (.+?)\?seek=(\d+) HTTP/1\.0', data, re.MULTILINE)
+			track = self.backend.get_track(m.group(1))
+			seek  = m.group(2)
+			if track.uri.startswith('file://'):
+				path = track.uri[7:]
+			else:
+				path = track.uri
+			path = urllib.unquote(path)
+			self.decoder = Decoder(path)
+		except Exception, e:
+			self.decoder = None
+			return 'HTTP/1.0 404 Not Found\r\n\r\n'
+
+		try:
+			if not self.decoder.seek(int(seek)):
+				self.wanted = int(seek)
+		except Exception, e:
+			traceback.print_exc()
+
+		# device expects an HTTP response in return. the decoder is asked for
+		# data to stream once the response has been sent.
+		response = ( 'HTTP/1.0 200 OK\r\n'
+		           + 'Content-Type: %s\r\n' % self.decoder.mimetype
+		           + '\r\n\r\n' )
+		return response
+
+	def close(self):
+		try:
+			self.socket.close()
+		except:
+			pass
+		self.decoder = None
+
+# accepts connections to a socket and feeds every connected device its own
+# stream. all streams are served by a single thread that select()s on the
+# listening socket and all connections, so one content manager can feed any
+# number of devices at the same time.
+#
+# a seek in a FLAC file that flacseek.py can't handle needs the frame offsets
+# from the seek index, and if the file hasn't been indexed yet all its frames
+# have to be walked with libFLAC first. that can take many seconds, so it is
+# done by a worker thread while the select() thread keeps serving the other
+# streams. the worker posts the offsets to 'indexed' and wakes the select()
+# up through a pipe, after which the stream continues from the right frame.
 class Streamer(Thread):
 	state   = STOPPED
-	socket  = None
+	socket  = None # the listening socket
 	port    = 0
-	decoder = None # a Decoder object
+	streams = None # connected socket -> Stream
 	backend = None
+	indexed = None # Queue of (socket, decoder, frame offsets) from workers
+	pipe    = None # (read fd, write fd). used to wake the thread up early
 
 	def __init__(self, backend, queue):
 		Thread.__init__(self, target=Streamer.run, name='Streamer')
@@ -48,27 +202,18 @@ class Streamer(Thread):
 		self.port    = 3485
 		self.backend = backend
 		self.queue   = queue
-
-	def accept(self):
-		if self.state != STARTING:
-			raise Excepion(
-				'Streamer.accept() called in wrong state %d' % self.state
-			)
-		if self.socket:
-			try:
-				#self.socket.flush()
-				self.socket.shutdown(socket.SHUT_RDWR)
-			except Exception, e:
-				if type(e) == socket.error and e[0] == errno.ENOTCONN:
-					pass
-				else:
-					print('INTERNAL ERROR')
-					traceback.print_exc()
-					self.stop()
-					return
-			self.socket.close()
+		self.streams = {}
+		self.indexed = Queue()
+		self.pipe    = os.pipe()
+		for fd in self.pipe:
+			flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	# bind the listening socket. it stays bound for as long as the streamer
+	# runs.
+	def listen(self):
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
 		while self.state != STOPPED: # in case someone forces a full teardown.
 			try:
 				self.socket.bind(('', self.port))
@@ -77,137 +222,121 @@ class Streamer(Thread):
 				self.port = self.port + 1
 				pass
 		#print('Streamer accepting on %d' % self.port)
-		
+		self.socket.listen(socket.SOMAXCONN)
+		self.socket.setblocking(False)
 		self.state = RUNNING
 		self.queue.put(Accepting('', self.port))
 
-		# socket.accept() hangs and you can't abort by hitting CTRL-C on the
-		# command line (because the thread isn't the program main loop that
-		# receives the resulting SIGINT), so to be able to abort we set the
-		# socket to time out and then try again if self.state still permits it.
-		self.socket.listen(0)
-		self.socket.settimeout(0.5)
-		while self.state != STOPPED:
+	# take all the connections that are waiting
+	def accept(self):
+		while True:
 			try:
-				self.socket, address = self.socket.accept()
-				self.socket.setblocking(False)
-				#print('Streamer connected on %d' % self.port)
-				break
-			except:
-				pass
+				(s, address) = self.socket.accept()
+			except socket.error, e:
+				if e[0] not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+					print('Streamer accept() failed: %s' % str(e))
+				return
+			#print('Streamer connected to %s' % str(address))
+			self.streams[s] = Stream(s, self.backend)
 
 	def run(self):
+		self.listen()
+		# the select() timeout is just there to make sure we can break the
+		# loop when self.state goes STOPPED.
 		while self.state != STOPPED:
-			
-			if self.state == STARTING:
-				self.accept()
-
-			selected = [[self.socket], [], [self.socket]]
-			out_data = None
-			out_left = 0
-			while self.state == RUNNING:
-				events = select.select(selected[0],selected[1],selected[2],0.5)
-				if len(events[2]) > 0:
-					print('Streamer EXCEPTIONAL EVENT')
-					self.state = STOPPED
-					continue
-				if events == ([],[],[]):
-					# do nothing. the select() timeout is just there to make
-					# sure we can break the loop when self.state goes STOPPED.
+			readable = [self.socket, self.pipe[0]] + self.streams.keys()
+			writable = [s for s in self.streams if self.streams[s].writing]
+			try:
+				events = select.select(readable, writable, [], 0.5)
+			except select.error, e:
+				if e[0] == errno.EINTR:
 					continue
-
-				if len(events[0]) > 0:
-					try:
-						in_data = self.socket.recv(4096)
-					except socket.error, e:
-						if e[0] == errno.ECONNRESET:
-							#print('Streamer connection RESET')
-							self.state = STARTING
-							continue
-					except Exception, e:
-						print('INTERNAL ERROR')
-						traceback.print_exc()
-						self.stop()
-
-					if len(in_data) == 0:
-						continue
-
-					if in_data.startswith('GET '):
-						out_data = self.handle_http_get(in_data.decode('utf-8'))
-						out_left = len(out_data)
-						if out_left > 0:
-							selected[1] = [self.socket]
-						continue
-					else:
-						raise Exception, ( 'streamer got weird stuff to read:\n'
-						                 + 'len=%d\n' % len(in_data)
-						                 + 'data=%s\n' % in_data )
-
-				if len(events[1]) > 0:
-					if out_left == 0:
-						out_data = None
-						if self.decoder:
-							out_data = self.decoder.read()
-						if out_data:
-							out_left = len(out_data)
-						else:
-							out_left = 0
-							# annoyingly, the socket is always writable when we
-							# have already written everything there is to write.
-							# unselect writable to avoid high CPU utilization.
-							selected[1] = []
-							continue
-
-					else:
-						try:
-							sent = self.socket.send(out_data[-out_left:])
-							out_left = out_left - sent
-						except:
-							print('INTERNAL ERROR')
-							traceback.print_exc()
-							self.stop()
-						continue
-
+				raise
+			for s in events[1]:
+				self.handle(s, Stream.writable)
+			for s in events[0]:
+				if s == self.socket:
+					self.accept()
+				elif s == self.pipe[0]:
+					self.resume()
+				else:
+					self.handle(s, Stream.readable)
+		for s in self.streams.keys():
+			self.streams.pop(s).close()
+		self.socket.close()
+		os.close(self.pipe[0])
+		os.close(self.pipe[1])
 		#print('streamer is dead')
 
-	def handle_http_get(self, data):
-		# check what resource is requested and whether to start playing it
-		# at some offset:
-		print data.strip()
+	# let the stream handle an event and forget about it if it is gone
+	def handle(self, s, method):
+		stream = self.streams.get(s)
+		if not stream:
+			return # closed while handling an earlier event
 		try:
-			m = re.search('GET (.+?)\?seek=(\d+) HTTP/1\.0', data, re.MULTILINE)
-			track = self.backend.get_track(m.group(1))
-			seek  = m.group(2)
-			if track.uri.startswith('file://'):
-				path = track.uri[7:]
-			else:
-				path = track.uri
-			path = urllib.unquote(path)
-			# if path is the same as for previous request, then the user is
-			# seeking in the file and we can keep the old decoder. otherwise
-			# create a new one:
-			if (not self.decoder) or (self.decoder.path != path):
-				self.decoder = Decoder(path)
-			else:
-				self.decoder.__init__(path)
-		except Exception, e:
-			self.decoder = None
-			return 'HTTP/1.0 404 Not Found\r\n\r\n'
+			alive = method(stream)
+		except:
+			print('INTERNAL ERROR')
+			traceback.print_exc()
+			alive = False
+		if not alive:
+			del self.streams[s]
+			stream.close()
+			return
+		if stream.wanted != None and not stream.indexing:
+			stream.indexing = True
+			worker = Thread(
+				target=Streamer.index, name='Streamer index',
+				args=(self, s, stream.decoder)
+			)
+			worker.daemon = True
+			worker.start()
 
+	# runs in a worker thread. the decoder must not be used for anything else
+	# than finding the offsets because the select() thread may still use it.
+	def index(self, s, decoder):
 		try:
-			self.decoder.seek(int(seek))
-		except Exception, e:
+			frames = seekindex.get(decoder.path, decoder.file)
+		except:
 			traceback.print_exc()
+			frames = None
+		self.indexed.put((s, decoder, frames))
+		self.wake()
 
-		# device expects an HTTP response in return. tell the decoder to send
-		# the response next time it is asked for data to stream.
-		response = ( 'HTTP/1.0 200 OK\r\n'
-		           + 'Content-Type: %s\r\n' % self.decoder.mimetype
-		           + '\r\n\r\n' )
-		return response
+	def wake(self):
+		try:
+			os.write(self.pipe[1], 'x')
+		except OSError, e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	# continue the streams whose frame offsets have been found
+	def resume(self):
+		try:
+			os.read(self.pipe[0], 4096)
+		except OSError, e:
+			if e.errno != errno.EAGAIN:
+				raise
+		while True:
+			try:
+				(s, decoder, frames) = self.indexed.get(block=False)
+			except Empty:
+				return
+			stream = self.streams.get(s)
+			if not stream or stream.decoder is not decoder:
+				continue # the device hung up while it waited
+			decoder.set_frames(frames)
+			try:
+				decoder.seek(stream.wanted)
+			except Exception, e:
+				traceback.print_exc()
+			stream.wanted   = None
+			stream.indexing = False
+			stream.writing  = True
 
 	def stop(self):
 		self.state = STOPPED
+		self.wake()
 
 # need an extra layer of protocol handlers that use decoder objects? i.e. to
 # support both files and remote streams.
@@ -217,7 +346,8 @@ class Decoder:
 	file     = None
 	audio    = None
 	frames   = None # FLAC (and other formats) must be streamed frame-aligned.
-	                # create the list of aligned offsets as needed.
+	                # array of aligned offsets, fetched from the seek index
+	                # by a worker of the Streamer as needed.
 	mimetype = None
 
 	def __init__(self, path):
@@ -245,6 +375,20 @@ class Decoder:
 			return self.file.read(amount)
 		return None
 
+	# send as much of the file as the socket takes, from the current position
+	# and without reading it into Python (see zerocopy.py). returns the number
+	# of bytes sent, which is zero at the end of the file.
+	def send(self, socket, amount=1024*1024):
+		if not self.file:
+			return 0
+		offset = self.file.tell()
+		sent = zerocopy.sendfile(
+			socket.fileno(), self.file.fileno(), offset, amount
+		)
+		self.file.seek(offset + sent)
+		return sent
+
+	# returns None if the frame offsets of the file are needed but unknown
 	def time_to_offset(self, msec):
 		if type(self.audio) == mutagen.mp3.EasyMP3:
 			if msec == 0:
@@ -254,53 +398,31 @@ class Decoder:
 			# offset: bytes per msec * time
 			return (self.audio.info.bitrate * msec) / 8000
 		if type(self.audio) == mutagen.flac.FLAC:
-			# find an aligned byte offset by picking the .frames[] index that
-			# most closely matches the seek value.
-			def make_frames():
-				if self.frames:
-					return
-
-				def target(path, queue):
-					# still don't trust ctypes. install signal handler for
-					# SIGSEGV so we can get out of this process somehow:
-					import signal
-					def handler(signum, frame):
-						print 'FlacDecoder caught SIGSEGV'
-						queue.put(None)
-					signal.signal(signal.SIGSEGV, handler)
-				
-					# path parameter must not be unicode:
-					dec = FlacDecoder(path.encode('utf-8'))
-					dec.skip_metadata()
-					frames = []
-					while dec.get_state() != END_OF_STREAM:
-						frames.append(dec.get_position())
-						dec.skip_frame()
-					queue.put(frames)
-
-				# astonishingly, the use of ctypes tends to cause SIGSEGV in
-				# libFLAC if there are enough other threads doing enough other
-				# work at the same time. there is no other thread using libFLAC
-				# and yet it will crash if there is enough other threaded
-				# activity going on. running the ctypes stuff from a process
-				# solves the problem:
-				q = Queue()
-				p = Process(target=target, args=(self.path, q))
-				p.daemon = True
-				p.start()
-				self.frames = q.get()
-				if self.frames == None:
-					self.frames = []
-				p.terminate()
-
+			# the frame can usually be found by looking at a few frame headers
+			# near the nearest seek point (see flacseek.py).
 			try:
-				make_frames()
+				size   = os.fstat(self.file.fileno()).st_size
+				offset = flacseek.time_to_offset(
+					self.audio, self.file, size, msec
+				)
+				if offset != None:
+					return offset
 			except Exception, e:
 				traceback.print_exc()
-				
+
+			# otherwise find an aligned byte offset by picking the .frames[]
+			# index that most closely matches the seek value. the offsets are
+			# kept in the seek index (see seekindex.py), so only the first
+			# seek in a file ever has to wait for libFLAC to walk all its
+			# frames. they are fetched in the background (see Streamer).
+			if self.frames == None:
+				return None
+			if not self.frames:
+				return 0
+
 			duration = self.audio.info.length * 1000
 			index = int((msec / duration) * len(self.frames))
-			if msec <= duration:
+			if index < len(self.frames):
 				result = self.frames[index]
 			else:
 				result = self.frames[-1]
@@ -312,11 +434,23 @@ class Decoder:
 
 		raise Exception('Unhandled execution path')
 
+	# 'frames' is None if the seek index couldn't get them, in which case
+	# seeks start from the beginning of the file.
+	def set_frames(self, frames):
+		if frames == None:
+			frames = []
+		self.frames = frames
+
 	# translate time to an offset into the file and let further read()'s
-	# continue from there.
+	# continue from there. returns False if the frame offsets of the file
+	# must be set with set_frames() before it can be done.
 	def seek(self, msec):
 		if msec > int(self.audio.info.length * 1000):
 			print('Too large time seek value %d' % msec)
-			return
-		self.file.seek(self.time_to_offset(msec))
+			return True
+		offset = self.time_to_offset(msec)
+		if offset == None:
+			return False
+		self.file.seek(offset)
+		return True
 
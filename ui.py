@@ -8,7 +8,7 @@ import sys
 import traceback
 import re
 
-from protocol   import Play, JsonResult, GetItem, Add
+from protocol   import Play, JsonResult, GetItem, Add, GetStats
 from menu       import make_item
 from device     import PlayItem, AddItem
 from connection import Connection
@@ -83,6 +83,24 @@ class UiConnection(Connection):
 			cm.wire.send(get.serialize())
 			return
 
+		if type(msg) == GetStats:
+			from dwite import scheduler
+			from render import strips
+			from wire   import reactor
+			import queues
+			devices = {}
+			for dm in get_dm(None):
+				devices[dm.mac_addr] = dm.dump_stats()
+			result = {
+				'devices'  : devices,
+				'scheduler': scheduler.dump(),
+				'reactor'  : reactor.dump(),
+				'strips'   : strips.dump(),
+				'queues'   : queues.dump()
+			}
+			msg.respond(0, u'EOK', 0, False, result)
+			return
+
 		msg.sender = self.label
 		try:
 			msg_reg.run_handler(msg)
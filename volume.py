@@ -1,8 +1,7 @@
-from datetime import datetime, timedelta
-
 from protocol import Audg, Aude
 from wire     import SlimWire
 from render   import VolumeMeter
+from clock    import monotonic
 
 class Volume:
 	wire    = None
@@ -11,7 +10,8 @@ class Volume:
 	left    = 0    # int 0-100
 	right   = 0    # int 0-100
 	meter   = None # VolumeMeter renderer
-	timeout = None # indicates how long the meter should be kept visible
+	timeout = None # indicates how long the meter should be kept visible.
+	               # in monotonic time, see clock.py
 	
 	def __init__(self, wire, preamp, left, right, visual, **ignore):
 		if not type(wire) == SlimWire:
@@ -30,7 +30,7 @@ class Volume:
 			self.meter = VolumeMeter()
 		self.mute(self._mute)
 		self.set_volume(left, right)
-		self.timeout = datetime.now()
+		self.timeout = monotonic()
 
 	@classmethod
 	def dump_defaults(cls):
@@ -63,11 +63,11 @@ class Volume:
 
 	def up(self):
 		self.set_volume(self.left + 1, self.right + 1)
-		self.timeout = datetime.now() + timedelta(milliseconds=1000)
+		self.timeout = monotonic() + 1.0
 
 	def down(self):
 		self.set_volume(self.left - 1, self.right - 1)
-		self.timeout = datetime.now() + timedelta(milliseconds=1000)
+		self.timeout = monotonic() + 1.0
 
 	def set_volume(self, left, right):
 		if left >= 0 and left <= 100:
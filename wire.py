@@ -4,20 +4,21 @@
 # under the terms of the GNU General Public License version 3, as published
 # by the Free Software Foundation.
 
+import os
 import socket
-import struct
 import select
-import sys
 import traceback
-import time
 import errno
+import fcntl
 
-from Queue     import Queue, Empty
-from threading import Thread
-from datetime  import datetime, timedelta
+from Queue     import Queue, Empty, Full
+from threading import Thread, Lock, Event
 from tactile   import IR
+from clock     import monotonic
+from queues    import MeteredQueue, BLOCK, DROP
 
 import protocol
+import recorder as recording
 
 STARTING = 1
 RUNNING  = 2
@@ -38,30 +39,175 @@ class Connected(object):
 class Stop(object):
 	pass
 
-class Wire(Thread):
+# all wires in a process share a single thread that waits for any of their
+# sockets to become readable or writable and then lets the wire in question
+# handle the event. the number of threads and the number of times the thread
+# wakes up only depend on the traffic, not on the number of connected devices,
+# content managers and user interfaces. all socket operations are done by the
+# reactor thread. other threads only talk to wires through their queues.
+class Reactor(Thread):
+	lock    = None
+	wires   = None  # all wires that have been started and haven't finished
+	alive   = True
+	started = False
+	pipe    = None  # (read fd, write fd). used to wake the thread up early
+	wakeups = 0     # number of times the reactor thread woke up
+
+	def __init__(self):
+		Thread.__init__(self, name='Reactor')
+		self.daemon = True
+		self.lock   = Lock()
+		self.wires  = []
+		self.pipe   = os.pipe()
+		# never block a thread just because the reactor is busy
+		flags = fcntl.fcntl(self.pipe[1], fcntl.F_GETFL)
+		fcntl.fcntl(self.pipe[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	def add(self, wire):
+		self.lock.acquire()
+		self.wires.append(wire)
+		if not self.started:
+			self.started = True
+			self.start()
+		self.lock.release()
+		self.wake()
+
+	def stop(self):
+		self.alive = False
+		self.wake()
+
+	def wake(self):
+		try:
+			os.write(self.pipe[1], 'x')
+		except OSError, e:
+			if e.errno != errno.EAGAIN:
+				raise # the pipe is full if the thread is already being woken
+
+	def dump(self):
+		self.lock.acquire()
+		try:
+			return {
+				'wires'  : len(self.wires),
+				'wakeups': self.wakeups
+			}
+		finally:
+			self.lock.release()
+
+	def run(self):
+		while self.alive:
+			self.lock.acquire()
+			# closed wires stay around until their backlog has been delivered
+			wires = [w for w in self.wires
+			         if w.backlog or not w.finished.is_set()]
+			self.wires = wires[:]
+			self.lock.release()
+
+			now     = monotonic()
+			rlist   = [self.pipe[0]]
+			wlist   = []
+			owners  = {}
+			timeout = None
+			for wire in wires:
+				try:
+					wire._step(now)
+					(readable, writable, deadline) = wire._interest(now)
+				except:
+					traceback.print_exc()
+					wire.stop(hard=True)
+					continue
+				if readable:
+					rlist.append(readable)
+					owners[readable] = wire
+				if writable:
+					wlist.append(writable)
+					owners[writable] = wire
+				if deadline != None:
+					if timeout == None or deadline - now < timeout:
+						timeout = max(0.0, deadline - now)
+
+			try:
+				events = select.select(rlist, wlist, [], timeout)
+			except (select.error, socket.error), e:
+				if e[0] in [errno.EINTR, errno.EBADF]:
+					continue # a socket was closed. the next round skips it
+				raise
+			self.wakeups += 1
+
+			if self.pipe[0] in events[0]:
+				events[0].remove(self.pipe[0])
+				try:
+					os.read(self.pipe[0], 4096)
+				except OSError:
+					pass
+			for s in events[1]:
+				try:
+					owners[s]._writable()
+				except:
+					traceback.print_exc()
+					owners[s].stop(hard=True)
+			for s in events[0]:
+				try:
+					owners[s]._readable()
+				except:
+					traceback.print_exc()
+					owners[s].stop(hard=True)
+
+		for wire in self.wires:
+			wire._close()
+
+reactor = Reactor()
+
+# wires post their messages to queues of this kind when they can. a consumer
+# that takes a message from a full queue wakes the reactor so that wires with
+# backlogs don't have to poll the queue to find out when there is room again.
+class WireQueue(MeteredQueue):
+	def _get(self):
+		if self.maxsize > 0 and len(self.queue) >= self.maxsize:
+			reactor.wake()
+		return MeteredQueue._get(self)
+
+class Wire(object):
+	name      = 'Wire'
 	label     = None
 	_state    = PAUSED
-	socket    = None
+	socket    = None # connected socket
+	connected = False # has the socket ever been connected?
 	host      = None
 	port      = 0
-	accept    = True
+	accept    = True # accepted by a Listener rather than connecting itself
 	in_queue  = None # in_queue is used by Wire's public methods to post
 	out_queue = None # messages that should be handled by the event loop.
 	                 # out_queue is passed in from outside to let us post
 	                 # messages to whoever instantiated the Wire.
+	inbox     = None # bytearray: received data that hasn't been handled yet
+	chunk     = None # bytearray: reused for every socket.recv_into()
+	outbox    = None # bytearray: payloads that haven't been written yet
+	high_water = 256 * 1024 # stop taking payloads from in_queue when the
+	                        # outbox holds this many bytes
+	backlog   = None # [(queue, message)] that couldn't be posted yet
+	connecting = False # waiting for a non-blocking connect() to finish
+	closing   = False # close the socket once the outbox has been written
+	retry_at  = None  # monotonic time of the next bind() or connect() attempt
+	finished  = None  # Event. set when the wire has closed its socket
+	recorder  = None  # recorder.Recorder shared by all wires, or None
+	recording = None  # the wire's connection number in the recorder
 
 	def __init__(self, host, port, queue, accept=True):
 		assert type(host) in [unicode, str]
 		assert type(port) == int
 		assert isinstance(queue, Queue)
 		assert type(accept) == bool
-		Thread.__init__(self, target=Wire.run, name='Wire')
 		self.state     = STARTING
 		self.host      = host
 		self.port      = port
 		self.accept    = accept
-		self.in_queue  = Queue(100)
+		self.in_queue  = MeteredQueue(u'%s in' % self.name, 100, self.in_policy)
 		self.out_queue = queue
+		self.inbox     = bytearray()
+		self.chunk     = bytearray(65536)
+		self.outbox    = bytearray()
+		self.backlog   = []
+		self.finished  = Event()
 
 	@property
 	def label(self):
@@ -75,246 +221,355 @@ class Wire(Thread):
 	def state(self, value):
 		if self._state == STOPPED:
 			return
-		if self._state == STOPPING and value != STOPPED:	
+		if self._state == STOPPING and value != STOPPED:
 			return
 		self._state = value
 
+	# wires used to be threads. keep the parts of the Thread API that users
+	# of wires rely on.
+	def start(self):
+		reactor.add(self)
+
+	def is_alive(self):
+		return not self.finished.is_set()
+
+	def join(self, timeout=None):
+		self.finished.wait(timeout)
+
 	def stop(self, hard=False):
 		if hard:
 			self._state = STOPPED
 		else:
 			self._state = STOPPING
 			self.in_queue.put(Stop())
+		reactor.wake()
 
+	# returns False if the payload was dropped because the in_queue was full
+	# and its policy allows it. see in_policy().
 	def send(self, payload):
-		self.in_queue.put(payload)
-
-	# protected methods below. only to be called by self (incl. subclasses)
-
-	def _accept(self):
-		if self.state != STARTING:
-			print('%s.accept() called in wrong state %d'
-			      % (self.label, self.state))
-			sys.exit(1)
-		if self.socket:
-			self.socket.close()
-		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-
-		#print('%s waiting for port %d to become available'
-		#      % (self.label, self.port))
-		while self.state not in [STOPPED, STOPPING]:
-			try:
-				self.socket.bind(('', self.port))
-				break
-			except:
-				time.sleep(0.5) # avoid spending 99% CPU time
-		#print('%s accepting on %d' % (self.label, self.port))
-
-		# socket.accept() hangs and you can't abort by hitting CTRL-C on the
-		# command line (because the thread isn't the program main loop that
-		# receives the resulting SIGINT), so to be able to abort we set the
-		# socket to time out and then try again if self.state still permits it.
-		self.socket.listen(1)
-		self.socket.settimeout(0.5)
-		while self.state not in [STOPPED, STOPPING]:
+		sent = self.in_queue.put(payload)
+		reactor.wake()
+		return sent
+
+	# what to do with a payload that is sent while the in_queue is full. the
+	# default is to block the sender until there is room.
+	def in_policy(self, payload):
+		return BLOCK
+
+	# protected methods below. only to be called by the reactor thread or by
+	# self (incl. subclasses)
+
+	# messages for other threads are posted without blocking because that
+	# would block all other wires as well. if the queue is full, the message
+	# is kept in the backlog and the wire stops reading from its socket until
+	# the backlog has been delivered.
+	def _post(self, queue, message):
+		if not self.backlog:
 			try:
-				self.socket, address = self.socket.accept()
-				self.socket.setblocking(False)
-				#print('%s connected to %s:%d' % (self.label, address,self.port))
-				old_queue = self.out_queue
-				self.out_queue = Queue(100)
-				old_queue.put(Connected(address, self.port, self))
-				self.state = RUNNING
-				break
-			except:
+				queue.put(message, block=False)
+				return
+			except Full:
 				pass
+		self.backlog.append((queue, message))
 
-	def _connect(self):
-		if self.socket:
-			self.socket.close()
-		while self.state not in [STOPPED, STOPPING]:
+	def _deliver(self):
+		while self.backlog:
+			(queue, message) = self.backlog[0]
 			try:
-				self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				self.socket.settimeout(0.5)
-				self.socket.connect((self.host, self.port))
-				self.socket.setblocking(False)
-				self.state = RUNNING
-				self.out_queue.put(Connected(self.host, self.port, self))
+				queue.put(message, block=False)
+			except Full:
+				return
+			del self.backlog[0]
+
+	# advance the wire's state machine. called once per reactor round.
+	def _step(self, now):
+		self._deliver()
+		if self.state == STOPPED:
+			self._close()
+			return
+		if self.state == STARTING:
+			if self.accept:
+				return
+			if self.connecting:
+				if now >= self.retry_at:
+					# the connect() timed out. start over in a while
+					self.socket.close()
+					self.socket     = None
+					self.connecting = False
+					self.retry_at   = now + 1.0
+				return
+			if self.retry_at != None and now < self.retry_at:
+				return
+			self._connect(now)
+			return
+		if self.state == STOPPING and not self.socket:
+			self.state = STOPPED
+			self._close()
+			return
+		if self.state in [RUNNING, STOPPING]:
+			if not self.closing:
+				self._drain()
+			if self.closing and not self.outbox:
+				self.state = STOPPED
+				self._close()
+				return
+			deadline = self._deadline()
+			if deadline != None and deadline <= now:
+				self._handle(None, None, None)
+
+	# returns (socket to read or None, socket to write or None, deadline or
+	# None) for the reactor's next call to select().
+	def _interest(self, now):
+		deadline = None
+		if self.backlog and not isinstance(self.backlog[0][0], WireQueue):
+			deadline = now + 0.05 # nothing will wake the reactor. poll
+		if self.state == STOPPED:
+			return (None, None, deadline)
+		if self.connecting:
+			return (None, self.socket, self.retry_at)
+		if self.state == STARTING:
+			return (None, None, self.retry_at)
+		readable = None
+		writable = None
+		if not self.backlog:
+			readable = self.socket
+		if self.outbox:
+			writable = self.socket
+		own = self._deadline()
+		if own != None and (deadline == None or own < deadline):
+			deadline = own
+		return (readable, writable, deadline)
+
+	def _connect(self, now):
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.setblocking(False)
+		result = self.socket.connect_ex((self.host, self.port))
+		if result in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+			# finished in _writable() when the socket becomes writable, or
+			# abandoned by _step() if that hasn't happened by retry_at.
+			self.connecting = True
+			self.retry_at   = now + 5.0
+			return
+		self.socket.close()
+		self.socket   = None
+		self.retry_at = now + 1.0 # stop pointless runaway loop
+
+	def _connected(self):
+		self.inbox     = bytearray()
+		self.outbox    = bytearray()
+		self.connected = True
+		self.state     = RUNNING
+		if self.recorder:
+			self.recording = self.recorder.open(self.name, self.port)
+
+	# take over a socket that was accepted by a Listener
+	def _adopt(self, s):
+		self.socket = s
+		self.socket.setblocking(False)
+		self._connected()
+
+	def _readable(self):
+		# read whatever is available and handle all the complete messages it
+		# contains. partial messages stay buffered until the rest arrives.
+		if not self._fill():
+			return
+		self._consume()
+
+	# handle all complete messages in the inbox and remove them from it
+	def _consume(self):
+		(frames, offset) = self._frames()
+		# the bodies are handed over as views into the inbox to avoid copying
+		# them before they are parsed.
+		view = memoryview(self.inbox)
+		for (kind, size, start) in frames:
+			self._handle(kind, size, view[start:start+size])
+			if self.state not in [RUNNING, STOPPING]:
 				break
-			except Exception, e:
+		del view
+		# a bytearray can't be resized while there are views of it, so keep
+		# the rest in a new one rather than deleting from the front. there is
+		# usually not much left after the last complete message.
+		if offset:
+			self.inbox = self.inbox[offset:]
+
+	def _writable(self):
+		if self.connecting:
+			self.connecting = False
+			error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if error:
 				self.socket.close()
-				time.sleep(1) # stop pointless runaway loop
-
-	def run(self):
-		while self.state != STOPPED:
-		
-			if self.state == PAUSED:
-				time.sleep(0.5)
-				continue
+				self.socket   = None
+				self.retry_at = monotonic() + 1.0
+				return
+			self.retry_at = None
+			self._connected()
+			self._post(self.out_queue, Connected(self.host, self.port, self))
+			return
+		# write as much of the outbox as the socket will take. the rest is
+		# written the next time the socket is writable.
+		self._flush()
 
-			if self.state == STARTING:
-				if self.accept:
-					self._accept()
-				else:
-					self._connect()
-
-			payload = None
-			while self.state in [RUNNING, STOPPING]:
-				# check first if we have payloads to send on the socket. don't
-				# block on empty queue.
-				if not payload:
-					try:
-						payload = self.in_queue.get(block=False, timeout=None)
-						if type(payload) == Stop:
-							self.state = STOPPED
-							continue
-						else:
-							wlist = [self.socket]
-					except Empty:
-						wlist = []
-					except:
-						traceback.print_exc()
-						self.stop(hard=True)
-						continue
-
-				rlist = [self.socket]
-				xlist = [self.socket]
-				events = select.select(rlist, wlist, xlist, 0.02)
-				if len(events[2]) > 0:
-					print('%s EXCEPTIONAL EVENT' % self.label)
-					self.state = STOPPED
-					continue
-				
-				if events == ([],[],[]):
-					# do nothing. the select() timeout is just there to make
-					# sure we can break the loop when self.state goes STOPPED.
-					# the call to handle nothing ensures that stacked up events
-					# get handled. wires with no stacked events are supposed
-					# to return immediately.
-					self._handle(None, None, None)
-					continue
+	def _close(self):
+		if self.finished.is_set():
+			return
+		if self.socket:
+			self.socket.close()
+		if self.recording != None:
+			self.recorder.write(self.recording, recording.CLOSE, '')
+		self._stopped()
+		self.finished.set()
+		#print '%s is dead' % self.label
 
-				if len(events[1]) > 0:
-					# it is conceivable that outgoing payload was assigned at
-					# a time when the socket was not writable. we do not wait
-					# for it to become writable and just skip to receiving
-					# instead. in this case the payload still remains. send it
-					# now.
-					if payload:
-						self._send(payload)
-						payload = None
-
-				if len(events[0]) > 0:
-					# all socket messages start with an 8 byte header that
-					# contains some meta data: message kind and it's size.
-					head = self._recv(8)
-					if not head:
-						continue
-					(kind, size) = protocol.parse_header(head)
-					if not kind:
-						continue
-					# receive the rest of the message
-					body = self._recv(size)
-					if size != len(body):
-						print('WARNING: size field is wrong! %d != %d'
-						      % (size, len(body)))
-					self._handle(kind, size, body)
+	# called when the wire has been closed. subclasses may override
+	def _stopped(self):
+		pass
 
-		self.socket.close()
-		#print '%s is dead' % self.label
+	# the monotonic time at which _handle(None, None, None) should be called
+	# even if nothing happens on the socket, or None.
+	def _deadline(self):
+		return None
 
 	def _handle(self, kind, size, body):
 		raise Exception, 'Wire subclasses must implement _handle()'
 
-	def _send(self, data, force=False):
-		if self.state not in [RUNNING, STOPPING] and force == False:
-			print('%s restarting. Dropped %s' % (self.label, data))
-			return
-		left = len(data)
-		while left > 0 and self.state in [RUNNING, STOPPING]:
+	# move payloads from in_queue to the outbox until the queue is empty or the
+	# outbox holds at least high_water bytes. in the latter case the payloads
+	# stay in the queue and senders block on it when it fills up, until the
+	# peer has caught up.
+	def _drain(self):
+		while len(self.outbox) < self.high_water:
 			try:
-				sent = self.socket.send(data[-left:])
-				if sent == 0:
-					#print('send() Connection broken')
-					self.stop(hard=True)
-					return
-				left = left - sent
-			except socket.error, e:
-				if e[0] == errno.ECONNRESET:
-					#print('send() Connection reset')
-					self.stop(hard=True)
-					return
-				elif e[0] == errno.EAGAIN: # temporarily unavailable. try again
-					#print('send() Connection unavailable')
-					continue
-				elif e[0] == errno.EPIPE: # broken pipe. disconnect
-					#print('send() Broken pipe')
-					self.stop(hard=True)
-					return
-				else:
-					print('send() Unhandled socket error %d' % e[0])
-					self.stop(hard=True)
-			except Exception, e:
-				print('%s: Unhandled exception %s' % (self.label, str(e)))
+				payload = self.in_queue.get(block=False)
+			except Empty:
+				return
+			if type(payload) == Stop:
+				# everything that was sent before the Stop is still expected
+				# to reach the peer.
+				self.closing = True
+				return
+			self.outbox += payload
+
+	# write as much of the outbox as the socket accepts without blocking
+	def _flush(self):
+		try:
+			sent = self.socket.send(self.outbox)
+			if sent == 0:
+				#print('send() Connection broken')
 				self.stop(hard=True)
-
-	def _recv(self, size):
-		body = ''
-		left = size
-		while left > 0 and self.state in [RUNNING, STOPPING]:
-			amount = min(left, 65536)
-			try:
-				r = None
-				r = self.socket.recv(amount)
-				if r == '':
-					#print('recv() Connection broken')
-					self.stop(hard=True)
-					return
-				body = body + r
-				left = left - len(r)
-			except socket.error, e:
-				if e[0] == errno.ECONNRESET:
-					#print('recv() Connection reset')
-					self.stop(hard=True)
-					return None
-				elif e[0] == errno.EAGAIN: # temporarily unavailable. try again
-					#print('recv() Conection unavailable')
-					continue
-				elif e[0] == errno.EPIPE: # broken pipe. disconnect
-					#print('recv() Broken pipe')
-					self.stop(hard=True)
-					return None
-				else:
-					print('Unhandled socket error %d' % e[0])
-					self.stop(hard=True)
-			except Exception, e:
-				print('%s: Unhandled exception %s' % (self.label, str(e)))
+				return
+			if self.recording != None:
+				self.recorder.write(
+					self.recording, recording.OUT, buffer(self.outbox, 0, sent)
+				)
+			del self.outbox[:sent]
+		except socket.error, e:
+			if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+				# temporarily unavailable. try again when select() says the
+				# socket is writable.
+				return
+			elif e[0] == errno.ECONNRESET:
+				#print('send() Connection reset')
 				self.stop(hard=True)
-				return None
-		return body
-
+			elif e[0] == errno.EPIPE: # broken pipe. disconnect
+				#print('send() Broken pipe')
+				self.stop(hard=True)
+			else:
+				print('send() Unhandled socket error %d' % e[0])
+				self.stop(hard=True)
+		except Exception, e:
+			print('%s: Unhandled exception %s' % (self.label, str(e)))
+			self.stop(hard=True)
+
+	# read as much as the socket has to offer, up to the size of the chunk,
+	# and append it to the inbox. returns False if nothing could be read.
+	def _fill(self):
+		try:
+			count = self.socket.recv_into(self.chunk)
+			if count == 0:
+				#print('recv() Connection broken')
+				self.stop(hard=True)
+				return False
+			self.inbox += buffer(self.chunk, 0, count)
+			if self.recording != None:
+				self.recorder.write(
+					self.recording, recording.IN, buffer(self.chunk, 0, count)
+				)
+			return True
+		except socket.error, e:
+			if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+				# temporarily unavailable. select() will tell when to try
+				# again, so don't spin on it.
+				return False
+			elif e[0] == errno.ECONNRESET:
+				#print('recv() Connection reset')
+				self.stop(hard=True)
+			elif e[0] == errno.EPIPE: # broken pipe. disconnect
+				#print('recv() Broken pipe')
+				self.stop(hard=True)
+			else:
+				print('Unhandled socket error %d' % e[0])
+				self.stop(hard=True)
+		except Exception, e:
+			print('%s: Unhandled exception %s' % (self.label, str(e)))
+			self.stop(hard=True)
+		return False
+
+	# find all complete messages at the front of the inbox. returns a list of
+	# (kind, size, start) tuples, where start is the offset of the message body
+	# in the inbox, and the number of bytes that the messages cover.
+	def _frames(self):
+		frames = []
+		offset = 0
+		inbox  = self.inbox
+		while len(inbox) - offset >= 8:
+			# all socket messages start with an 8 byte header that contains
+			# some meta data: message kind and it's size.
+			(kind, size) = protocol.parse_header(inbox, offset)
+			if not kind:
+				offset += 8
+				continue
+			if len(inbox) - offset - 8 < size:
+				break # the rest of the message hasn't arrived yet
+			frames.append((kind, size, offset + 8))
+			offset += 8 + size
+		return (frames, offset)
 
 class SlimWire(Wire):
+	name   = 'SlimWire'
 	escrow = None
 
-	def __init__(self, host, port, queue, accept=True):
-		Wire.__init__(self, host, port, queue, accept)
-		self.name = 'SlimWire'
+	# a device that can't keep up with the frames is better off without the
+	# ones that don't fit. the display will diff the next frame against the
+	# last one that was queued. all other commands must arrive.
+	def in_policy(self, payload):
+		if type(payload) in [str, bytearray] and payload[2:6] == 'grfe':
+			return DROP
+		return BLOCK
+
+	def _stopped(self):
+		if not self.connected:
+			return # there is no device manager to tell
+		# device managers sleep until they get a message or have something to
+		# draw, so they won't notice that the wire died unless told about it.
+		self._post(self.out_queue, Stop())
+
+	def _deadline(self):
+		if self.escrow:
+			return self.escrow[1]
+		return None
 
 	def _handle(self, kind, size, body):
 		if not (kind or size or body):
-			# if we wake up for any non-exceptional reason and there is a
-			# tactile event in escrow, check if it has expired and if so
-			# send its negative version as a signal that the key has been
-			# released. this isn't completely fool proof, because the event
-			# can be overwritten by one for another key before it expires.
-			# i.e. first press '1' for a while and then quickly change to
-			# pressing '2'. not sure if this is really a problem.
-			if self.escrow and self.escrow[1] < datetime.now():
+			# if there is a tactile event in escrow, check if it has expired
+			# and if so send its negative version as a signal that the key
+			# has been released. this isn't completely fool proof, because
+			# the event can be overwritten by one for another key before it
+			# expires. i.e. first press '1' for a while and then quickly
+			# change to pressing '2'. not sure if this is really a problem.
+			if self.escrow and self.escrow[1] <= monotonic():
 				code   = -self.escrow[0].code
 				stress =  self.escrow[0].stress
-				self.out_queue.put(protocol.Tactile(code, stress))
+				self._post(self.out_queue, protocol.Tactile(code, stress))
 				self.escrow = None
 			return ''
 
@@ -325,28 +580,26 @@ class SlimWire(Wire):
 
 		if isinstance(message, protocol.Ureq):
 			print 'Ureq'
-			self.state = STARTING # must set this before sending UPDN to the
-			# device or race conditions come crashing in.
-			time.sleep(1.0)
-			self._send(Updn().serialize(), force=True)
-		
+			# tell the device to go ahead with the update and hang up. it will
+			# reconnect when it is done.
+			self.outbox += protocol.Updn().serialize()
+			self.closing = True
+
 		elif isinstance(message, protocol.Tactile):
 			if message.code in [IR.FORWARD, IR.REWIND, IR.POWER]:
-				timeout = datetime.now() + timedelta(milliseconds=300)
-				self.escrow = (message, timeout)
+				self.escrow = (message, monotonic() + 0.3)
 				if message.stress < 5:
 					# don't post an event since we can't tell
 					# yet if the user wants a tap or a long press.
 					return
-			self.out_queue.put(message)
+			self._post(self.out_queue, message)
 
 		else:
-			self.out_queue.put(message)
+			self._post(self.out_queue, message)
 
 class JsonWire(Wire):
-	def __init__(self, host, port, queue, accept=True):
-		Wire.__init__(self, host, port, queue, accept)
-		self.name = 'JsonWire'
+	name  = 'JsonWire'
+	codec = None # codec.py codec for replies, as negotiated in Hail. or JSON
 
 	def _handle(self, kind, size, body):
 		if not (kind or size or body):
@@ -357,5 +610,79 @@ class JsonWire(Wire):
 			print('WARNING: jsonwire parse_body() produced NOTHING!')
 			return
 		message.wire = self
-		self.out_queue.put(message)
+		self._post(self.out_queue, message)
+
+# listens on a port for as long as it lives and creates a new wire for every
+# connection that it accepts. the wire is announced with a Connected message and
+# posts everything it receives to a queue of its own, which is available as
+# the wire's out_queue.
+class Listener(Wire):
+	name        = 'Listener'
+	factory     = None # Wire subclass to create for accepted connections
+	listener    = None # the listening socket
+	connections = socket.SOMAXCONN # the listen() backlog
+
+	def __init__(self, port, factory, queue):
+		Wire.__init__(self, '', port, queue, accept=True)
+		self.factory = factory
+
+	def _step(self, now):
+		self._deliver()
+		if self.state in [STOPPED, STOPPING]:
+			self.state = STOPPED
+			self._close()
+			return
+		if self.listener:
+			return
+		if self.retry_at != None and now < self.retry_at:
+			return
+		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+		try:
+			s.bind(('', self.port))
+		except socket.error:
+			# the port is taken. try again in a while
+			s.close()
+			self.retry_at = now + 0.5
+			return
+		s.listen(self.connections)
+		s.setblocking(False)
+		self.listener = s
+		self.retry_at = None
+		self.state    = RUNNING
+		#print('%s accepting on %d' % (self.label, self.port))
 
+	def _interest(self, now):
+		deadline = None
+		if not self.listener:
+			deadline = self.retry_at # time to try bind() again
+		if self.backlog and not isinstance(self.backlog[0][0], WireQueue):
+			deadline = now + 0.05 # nothing will wake the reactor. poll
+		if self.state == STOPPED:
+			return (None, None, deadline)
+		return (self.listener, None, deadline)
+
+	def _readable(self):
+		# take all the connections that are waiting. e.g. several devices
+		# that reconnect at the same time after a power outage.
+		while True:
+			try:
+				(s, address) = self.listener.accept()
+			except socket.error, e:
+				if e[0] not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+					print('%s accept() failed: %s' % (self.label, str(e)))
+				return
+			#print('%s connected to %s:%d' % (self.label, address, self.port))
+			queue = WireQueue(u'%s out' % self.factory.name, 100)
+			wire  = self.factory(u'', self.port, queue, accept=True)
+			wire._adopt(s)
+			reactor.add(wire)
+			self._post(self.out_queue, Connected(address, self.port, wire))
+
+	def _close(self):
+		if self.finished.is_set():
+			return
+		if self.listener:
+			self.listener.close()
+			self.listener = None
+		self.finished.set()
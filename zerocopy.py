@@ -0,0 +1,58 @@
+# Copyright 2011 Klas Lindberg <klas.lindberg@gmail.com>
+
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# sends files to sockets without reading them into Python first. the kernel
+# copies the data straight from the page cache to the socket. Python 2 has no
+# os.sendfile(), so use the pysendfile module if it is installed. otherwise ask
+# the C library directly (Linux only, because the BSDs and Darwin have a
+# different sendfile()). 'sendfile' is None if neither is available.
+
+import os
+import sys
+import ctypes
+import ctypes.util
+
+try:
+	import sendfile as pysendfile
+except ImportError:
+	pysendfile = None
+
+def load_sendfile():
+	if not sys.platform.startswith('linux'):
+		return None
+	path = ctypes.util.find_library('c')
+	if not path:
+		return None
+	try:
+		libc = ctypes.CDLL(path, use_errno=True)
+		# the 64 bit version takes 64 bit offsets even on 32 bit systems
+		function = libc.sendfile64
+	except Exception:
+		return None
+	function.restype  = ctypes.c_ssize_t
+	function.argtypes = [
+		ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+		ctypes.c_size_t
+	]
+
+	def sendfile(out_fd, in_fd, offset, count):
+		position = ctypes.c_int64(offset)
+		sent = function(out_fd, in_fd, ctypes.byref(position), count)
+		if sent < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		return sent
+	return sendfile
+
+# sendfile(out_fd, in_fd, offset, count) sends up to 'count' bytes of the file
+# 'in_fd', starting at 'offset', to the socket 'out_fd'. it returns the number
+# of bytes sent, which is zero at the end of the file, and raises OSError with
+# EAGAIN if the socket is non-blocking and can't take anything right now. the
+# file's own position is not changed.
+if pysendfile:
+	sendfile = pysendfile.sendfile
+else:
+	sendfile = load_sendfile()